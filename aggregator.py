@@ -0,0 +1,116 @@
+"""Fusing the sightings of several scanners into one room per device.
+
+Scanners send each device's smoothed RSSI to the aggregator in small UDP
+datagrams instead of reporting to Vera themselves, along with how long the
+reading holds: beacons are heard all the time, but phones only when they
+are polled.  The aggregator keeps each scanner's latest reading until it
+lapses, places each device at the scanner that hears it loudest, and only
+tells Vera when that changes (or to keep the device present).
+"""
+
+import errno
+import logging
+import socket
+import struct
+import time
+
+logger = logging.getLogger('Bluetooth Scanner')
+
+# device (Vera id), scanner name, RSSI, time seen, how long it holds (s)
+SIGHTING = struct.Struct('!I16sbdf')
+
+
+class SightingSender(object):
+    """Send sightings to an aggregator.  Never blocks."""
+
+    def __init__(self, host, port, scanner_name):
+        self.address = (host, port)
+        self.scanner_name = scanner_name[:16]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, device_id, rssi, when, valid):
+        """Send a reading of a device that holds for valid seconds."""
+        record = SIGHTING.pack(int(device_id), self.scanner_name,
+                               max(-128, min(127, int(round(rssi)))), when,
+                               valid)
+        try:
+            self.sock.sendto(record, self.address)
+        except socket.error, e:
+            logger.debug('Failed to send sighting to aggregator: %s' % e)
+
+
+class Aggregator(object):
+    """Receive sightings and pick the nearest scanner for each device.
+
+    Arguments:
+    port --- UDP port to listen on
+    margin --- how much louder (dB) another scanner must hear a device
+               before the device is moved to its room
+    keepalive --- how often an unchanged room is sent again (s)
+    report --- function(device_id, scanner, rssi) telling Vera
+    """
+
+    def __init__(self, port, margin, keepalive, report):
+        self.margin = margin
+        self.keepalive = keepalive
+        self.report = report
+        self.readings = {}
+        self.rooms = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        """Handle every sighting waiting on the socket."""
+        while True:
+            try:
+                data = self.sock.recv(SIGHTING.size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if len(data) != SIGHTING.size:
+                continue
+            # Scanner clocks may not agree, so time sightings by arrival
+            device_id, scanner, rssi, when, valid = SIGHTING.unpack(data)
+            self.add(str(device_id), scanner.rstrip('\0'), rssi,
+                     time.time() + valid)
+
+    def add(self, device_id, scanner, rssi, expires):
+        """Record one sighting and report the device's room if needed."""
+        readings = self.readings.setdefault(device_id, {})
+        readings[scanner] = (rssi, expires)
+        now = time.time()
+        best = None
+        for name, (reading, until) in readings.items():
+            if until < now:
+                del readings[name]
+            elif best is None or reading > readings[best][0]:
+                best = name
+        if best is None:
+            return
+        room, last_report = self.rooms.get(device_id, (None, 0))
+        if (room in readings and room != best
+                and readings[best][0] < readings[room][0] + self.margin):
+            best = room
+        if best != room:
+            logger.debug('Device %s is now nearest %s' % (device_id, best))
+        elif now - last_report < self.keepalive:
+            return
+        self.report(device_id, best, readings[best][0])
+        self.rooms[device_id] = (best, now)
+
+    def sweep(self):
+        """Forget readings that have lapsed, and devices with none left."""
+        now = time.time()
+        for device_id, readings in self.readings.items():
+            for name, (reading, until) in readings.items():
+                if until < now:
+                    del readings[name]
+            if not readings:
+                del self.readings[device_id]
+                self.rooms.pop(device_id, None)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Benchmark the scanner's hot paths without a bluetooth adapter or Vera.
+
+Synthetic captures with different numbers of beacons (or a real btsnoop
+capture given with --capture) are replayed through replay.ReplaySocket to
+measure:
+
+  decode   --- adverts per second and CPU per 1000 adverts decoded by
+               blescan.parse_events()
+  match    --- the same through the full per advert path in run_scanner
+               (decode, beacon lookup and presence state)
+  latency  --- time from a beacon's first advert being read off the socket
+               to its SetPresent action reaching a replay.FakeVera
+"""
+
+import argparse
+import logging
+import random
+import resource
+import sys
+import time
+import blescan
+import replay
+import run_scanner
+import vera
+
+DENSITIES = [1, 10, 50, 200]
+UUID = '\xe2\xc5\x6d\xb5\xdf\xfb\x48\xd2\xb0\x60\xd0\xf5\xa7\x10\x96\xe0'
+
+
+def make_beacons(count):
+    """Return count (packed mac, ad data) beacons, half matched by MAC."""
+    beacons = []
+    for i in range(count):
+        mac = '\xfe\xed' + chr(i >> 8 & 0xff) + chr(i & 0xff) + '\x00\xc0'
+        beacons.append((mac, replay.ibeacon_data(UUID, 1, i)))
+    return beacons
+
+
+def make_packets(beacons, adverts, interval=0.0):
+    """Build packets of 1 to 3 reports from randomly chosen beacons."""
+    rand = random.Random(1)
+    packets = []
+    total = 0
+    stamp = 0.0
+    while total < adverts:
+        reports = []
+        for i in range(min(rand.randint(1, 3), adverts - total)):
+            mac, data = rand.choice(beacons)
+            reports.append((mac, data, rand.randint(-95, -40)))
+        packets.append((stamp, replay.advert_packet(reports)))
+        total += len(reports)
+        stamp += interval
+    return packets
+
+
+def user_data(beacons):
+    """Build a Vera user_data document with a sensor for each beacon."""
+    devices = []
+    for i, (mac, data) in enumerate(beacons):
+        if i % 2:
+            address = blescan.packed_bdaddr_to_string(mac).upper()
+        else:
+            address = '%s,1,%d' % (UUID.encode('hex').upper(), i)
+        devices.append({
+            'id': 100 + i,
+            'device_type': run_scanner.DEV_TYPE,
+            'states': [
+                {'service': run_scanner.SVC_ID, 'variable': 'Address',
+                 'value': address},
+                {'service': run_scanner.SVC_ID, 'variable': 'DeviceType',
+                 'value': 'ibeacon'},
+                ]})
+    return {'DataVersion': 1, 'LoadTime': 1, 'devices': devices}
+
+
+def cpu_time():
+    """CPU time used by the process, to the microsecond rather than the tick."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_decode(packets):
+    """Returns (adverts, wall time, cpu time) for decoding all packets."""
+    sock = replay.ReplaySocket(packets)
+    start, start_cpu = time.time(), cpu_time()
+    adverts = blescan.parse_events(sock, len(packets))
+    elapsed, cpu = time.time() - start, cpu_time() - start_cpu
+    sock.close()
+    return len(adverts), elapsed, cpu
+
+
+def bench_match(packets, beacons):
+    """Returns (adverts, wall time, cpu time) for the full advert path."""
+    scanner = run_scanner.Scanner()
+    run_scanner.update_registry(
+        scanner.registry,
+        run_scanner.index_devices(user_data(beacons)['devices']))
+    scanner.scanners[0].open_dev = lambda dev_id: replay.ReplaySocket(packets)
+    scanner.scanners[0].open()
+    count = 0
+    start, start_cpu = time.time(), cpu_time()
+    for i in xrange(len(packets)):
+        for advert in scanner.scanners[0].read():
+            scanner.process_advert(advert)
+            count += 1
+    elapsed, cpu = time.time() - start, cpu_time() - start_cpu
+    scanner.scanners[0].close()
+    return count, elapsed, cpu
+
+
+def bench_latency(beacons, duration):
+    """Returns the advert to Vera latencies of each beacon."""
+    packets = make_packets(beacons, len(beacons) * 20,
+                           duration / (len(beacons) * 10.0))
+    fake_vera = replay.FakeVera(user_data(beacons))
+    fake_vera.start()
+    run_scanner.subscriber = vera.VeraSubscriber(
+        vera.VeraConnection('127.0.0.1', fake_vera.server_port),
+        run_scanner.DEV_TYPE, run_scanner.SVC_ID, ('Address', 'DeviceType'),
+        poll_timeout=1)
+    run_scanner.reporter = vera.VeraReporter(
+        vera.VeraConnection('127.0.0.1', fake_vera.server_port),
+        run_scanner.SVC_ID)
+    sockets = []
+
+    def open_dev(dev_id):
+        sockets.append(replay.ReplaySocket(packets, realtime=True))
+        return sockets[-1]
+
+    scanner = run_scanner.Scanner(open_dev=open_dev)
+    scanner.loop.call_later(duration * 2 + 1, scanner.loop.stop)
+    scanner.run()
+    run_scanner.subscriber.stop()
+    run_scanner.subscriber.join()
+    run_scanner.reporter.connection.close()
+    fake_vera.shutdown()
+    fake_vera.server_close()
+
+    first_sent = {}
+    for sent, pkt in sockets[0].sent if sockets else []:
+        for advert in blescan.parse_packet(pkt):
+            beacon = scanner.registry.match(advert)
+            if beacon is not None and beacon.id not in first_sent:
+                first_sent[beacon.id] = sent
+    latencies = []
+    for received, query in fake_vera.actions:
+        sent = first_sent.pop(query['DeviceNum'], None)
+        if sent is not None:
+            latencies.append(received - sent)
+    return sorted(latencies)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--capture', help='btsnoop capture to decode')
+    parser.add_argument('--adverts', type=int, default=20000,
+                        help='adverts per synthetic run (default 20000)')
+    parser.add_argument('--latency-time', type=float, default=2.0,
+                        help='seconds of adverts per latency run')
+    parser.add_argument('--densities', type=int, nargs='+',
+                        default=DENSITIES, help='beacon counts to test')
+    args = parser.parse_args()
+    run_scanner.logger.addHandler(logging.NullHandler())
+    run_scanner.logger.propagate = False
+    run_scanner.STATE_FILE = None
+
+    if args.capture:
+        packets = replay.read_btsnoop(args.capture)
+        adverts, elapsed, cpu = bench_decode(packets)
+        print 'decode %s: %d packets, %d adverts, %.0f adverts/s, ' \
+            '%.2f ms cpu/1000' % (args.capture, len(packets), adverts,
+                                  adverts / elapsed, cpu * 1e6 / adverts)
+        return 0
+
+    print '%8s %14s %12s %14s %12s %10s %10s' % (
+        'beacons', 'decode/s', 'cpu ms/1k', 'match/s', 'cpu ms/1k',
+        'lat p50', 'lat max')
+    for density in args.densities:
+        beacons = make_beacons(density)
+        packets = make_packets(beacons, args.adverts)
+        decoded, elapsed, cpu = bench_decode(packets)
+        matched, m_elapsed, m_cpu = bench_match(packets, beacons)
+        latencies = bench_latency(beacons, args.latency_time)
+        if latencies:
+            latency = '%8.1fms %8.1fms' % (percentile(latencies, 0.5) * 1e3,
+                                           latencies[-1] * 1e3)
+        else:
+            latency = '%10s %10s' % ('-', '-')
+        print '%8d %14.0f %12.2f %14.0f %12.2f %s' % (
+            density, decoded / elapsed, cpu * 1e6 / decoded,
+            matched / m_elapsed, m_cpu * 1e6 / matched, latency)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
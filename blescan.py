@@ -17,10 +17,19 @@ DEBUG = False
 
 import os
 import sys
+import errno
+import fcntl
+import mmap
+import multiprocessing
+import select
 import struct
+import time
+import collections
 import bluetooth._bluetooth as bluez
+import metrics
 
 LE_META_EVENT = 0x3e
+HCI_MAX_EVENT_SIZE = 258  # packet type, event code, length, 255 parameters
 LE_PUBLIC_ADDRESS=0x00
 LE_RANDOM_ADDRESS=0x01
 LE_SET_SCAN_PARAMETERS_CP_SIZE=7
@@ -32,6 +41,14 @@ OCF_LE_CREATE_CONN=0x000D
 LE_ROLE_MASTER = 0x00
 LE_ROLE_SLAVE = 0x01
 
+# LE scan parameters
+LE_SCAN_PASSIVE = 0x00
+LE_SCAN_ACTIVE = 0x01
+LE_FILTER_ACCEPT_ALL = 0x00
+LE_SCAN_UNIT = 0.625  # scan interval and window units (ms)
+LE_SCAN_MIN = 0x0004
+LE_SCAN_MAX = 0x4000
+
 # these are actually subevents of LE_META_EVENT
 EVT_LE_CONN_COMPLETE=0x01
 EVT_LE_ADVERTISING_REPORT=0x02
@@ -45,6 +62,43 @@ ADV_SCAN_IND=0x02
 ADV_NONCONN_IND=0x03
 ADV_SCAN_RSP=0x04
 
+# AD structure types
+AD_MANUFACTURER_DATA=0xFF
+
+# iBeacon manufacturer data: Apple company id, type 0x02, length 0x15
+IBEACON_PREFIX = '\x4c\x00\x02\x15'
+IBEACON_AD_LEN = 0x1A
+
+# Precompiled formats for decoding advertising reports
+EVENT_HEADER = struct.Struct("<BBBBB")  # ptype, event, plen, subevent, num
+REPORT_HEADER = struct.Struct("<BB6sB")  # evt_type, addr_type, addr, len
+AD_HEADER = struct.Struct("<BB")  # len, type
+IBEACON = struct.Struct(">4s16sHHb")  # prefix, uuid, major, minor, txpower
+RSSI = struct.Struct("<b")
+# type, interval, window, own address type, filter policy
+SCAN_PARAMETERS = struct.Struct("<BHHBB")
+
+# Shared memory ring of decoded adverts, see AdvertRing
+RING_HEADER = struct.Struct("<IIII")  # head, tail, packets, dropped
+RING_RECORD = struct.Struct("<6sB16sHHbb3x")  # mac, flags, uuid, major,
+                                              # minor, txpower, rssi
+RING_IBEACON = 0x01  # flag: uuid, major, minor and txpower are set
+
+hci_packets = metrics.counter('ble_hci_packets_total',
+                              'HCI packets read while scanning')
+decoded_adverts = metrics.counter('ble_adverts_decoded_total',
+                                  'Advertising reports decoded')
+scan_seconds = metrics.counter('ble_scan_seconds_total',
+                               'Time spent listening, the time LE scanning '
+                               'was enabled times window / interval')
+ring_dropped = metrics.counter('ble_ring_dropped_total',
+                               'Adverts dropped with the reader ring full')
+
+# A decoded advertising report.  mac is the packed address as sent over the
+# air (see packed_bdaddr_to_string), uuid is the raw 16 byte iBeacon UUID.
+Advert = collections.namedtuple(
+    'Advert', 'mac uuid major minor txpower rssi')
+
 
 def returnnumberpacket(pkt):
     myInteger = 0
@@ -75,13 +129,34 @@ def get_packed_bdaddr(bdaddr_string):
 def packed_bdaddr_to_string(bdaddr_packed):
     return ':'.join('%02x'%i for i in struct.unpack("<BBBBBB", bdaddr_packed[::-1]))
 
-def hci_enable_le_scan(sock):
-    hci_toggle_le_scan(sock, 0x01)
+def list_adapters():
+    """Return the numbers of the local HCI adapters, e.g. [0, 1]."""
+    try:
+        names = os.listdir('/sys/class/bluetooth')
+    except OSError:
+        return []
+    return sorted(int(name[3:]) for name in names
+                  if name.startswith('hci') and name[3:].isdigit())
+
+def hci_send_cmd(sock, ogf, ocf, cmd_pkt):
+    """Send an HCI command.
+
+    Sockets that are not real HCI sockets, like replay.ReplaySocket, handle
+    commands themselves through a send_cmd() method.
+    """
+    send_cmd = getattr(sock, 'send_cmd', None)
+    if send_cmd is not None:
+        send_cmd(ogf, ocf, cmd_pkt)
+    else:
+        bluez.hci_send_cmd(sock, ogf, ocf, cmd_pkt)
+
+def hci_enable_le_scan(sock, filter_dup=0x00):
+    hci_toggle_le_scan(sock, 0x01, filter_dup)
 
 def hci_disable_le_scan(sock):
     hci_toggle_le_scan(sock, 0x00)
 
-def hci_toggle_le_scan(sock, enable):
+def hci_toggle_le_scan(sock, enable, filter_dup=0x00):
 # hci_le_set_scan_enable(dd, 0x01, filter_dup, 1000);
 # memset(&scan_cp, 0, sizeof(scan_cp));
  #uint8_t         enable;
@@ -99,82 +174,444 @@ def hci_toggle_le_scan(sock, enable):
 
 #        if (hci_send_req(dd, &rq, to) < 0)
 #                return -1;
-    cmd_pkt = struct.pack("<BB", enable, 0x00)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
+    cmd_pkt = struct.pack("<BB", enable, filter_dup)
+    hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
 
 
-def hci_le_set_scan_parameters(sock):
-    old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
+def scan_units(ms):
+    """Convert a scan interval or window to controller units, in range."""
+    return max(LE_SCAN_MIN, min(LE_SCAN_MAX, int(round(ms / LE_SCAN_UNIT))))
 
-    SCAN_RANDOM = 0x01
-    OWN_TYPE = SCAN_RANDOM
-    SCAN_TYPE = 0x01
 
+def hci_le_set_scan_parameters(sock, active=False, interval=10, window=10,
+                               own_type=LE_PUBLIC_ADDRESS):
+    """Set how the controller scans.  Scanning must be disabled.
 
+    The controller listens for window ms at the start of every interval ms,
+    so window / interval is the fraction of time spent scanning.
 
-def parse_events(sock, loop_count=100):
+    Arguments:
+    active --- send scan requests to get scan responses too
+    interval --- time between the starts of scan windows (ms)
+    window --- length of each scan window (ms), no longer than interval
+    own_type --- LE_PUBLIC_ADDRESS or LE_RANDOM_ADDRESS, the address used
+                 in scan requests
+    """
+    interval = scan_units(interval)
+    window = min(scan_units(window), interval)
+    cmd_pkt = SCAN_PARAMETERS.pack(
+        LE_SCAN_ACTIVE if active else LE_SCAN_PASSIVE, interval, window,
+        own_type, LE_FILTER_ACCEPT_ALL)
+    hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, cmd_pkt)
+
+
+def format_advert(advert):
+    """Format an Advert as a 'mac,uuid,major,minor,txpower,rssi' string."""
+    if advert.uuid is None:
+        return '%s,,,,,%i' % (packed_bdaddr_to_string(advert.mac), advert.rssi)
+    return '%s,%s,%i,%i,%i,%i' % (packed_bdaddr_to_string(advert.mac),
+                                  advert.uuid.encode('hex'), advert.major,
+                                  advert.minor, advert.txpower, advert.rssi)
+
+
+def parse_packet(pkt, seen=None):
+    """Decode one HCI event packet into a list of adverts.
+
+    Every report in a (possibly multi report) LE advertising report event is
+    decoded, and its AD structures searched for an iBeacon payload.
+
+    Arguments:
+    pkt --- the raw packet as read from the HCI socket
+    seen --- optional set of packed MAC addresses.  Reports from these are
+             skipped without being decoded, and the others are added.
+
+    Returns:
+    list of Advert records, empty if the packet was not an advertising
+    report.  uuid, major, minor and txpower are None for adverts that are
+    not iBeacons.
+    """
+    end = len(pkt)
+    if end < EVENT_HEADER.size:
+        return []
+    buf = memoryview(pkt)
+    ptype, event, plen, subevent, num_reports = EVENT_HEADER.unpack_from(buf)
+    if event != LE_META_EVENT or subevent != EVT_LE_ADVERTISING_REPORT:
+        return []
+    adverts = []
+    offset = EVENT_HEADER.size
+    for i in xrange(num_reports):
+        if offset + REPORT_HEADER.size >= end:
+            break
+        evt_type, addr_type, mac, data_len = (
+            REPORT_HEADER.unpack_from(buf, offset))
+        ad = offset + REPORT_HEADER.size
+        data_end = ad + data_len
+        if data_end >= end:
+            break
+        offset = data_end + 1
+        if seen is not None:
+            if mac in seen:
+                continue
+            seen.add(mac)
+        rssi, = RSSI.unpack_from(buf, data_end)
+        uuid = major = minor = txpower = None
+        while ad + AD_HEADER.size <= data_end:
+            ad_len, ad_type = AD_HEADER.unpack_from(buf, ad)
+            if ad_len == 0:
+                break
+            if (ad_type == AD_MANUFACTURER_DATA
+                    and ad_len == IBEACON_AD_LEN
+                    and ad + 1 + ad_len <= data_end):
+                prefix, uuid, major, minor, txpower = (
+                    IBEACON.unpack_from(buf, ad + AD_HEADER.size))
+                if prefix == IBEACON_PREFIX:
+                    break
+                uuid = major = minor = txpower = None
+            ad += ad_len + 1
+        advert = Advert(mac, uuid, major, minor, txpower, rssi)
+        if DEBUG:
+            print "\t", format_advert(advert)
+        adverts.append(advert)
+    return adverts
+
+
+def hci_install_scan_filter(sock):
+    """Install the HCI event filter used while scanning.
+
+    Only LE meta events (which carry the advertising reports) and the
+    command complete/status events for our own commands are let through, so
+    the kernel drops all other traffic before it wakes us up.
+
+    Returns:
+    the previous filter, to be handed back to sock.setsockopt() when done
+    """
     old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
+    flt = bluez.hci_filter_new()
+    bluez.hci_filter_clear(flt)
+    bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
+    bluez.hci_filter_set_event(flt, LE_META_EVENT)
+    bluez.hci_filter_set_event(flt, bluez.EVT_CMD_COMPLETE)
+    bluez.hci_filter_set_event(flt, bluez.EVT_CMD_STATUS)
+    sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
+    return old_filter
+
 
+def parse_events(sock, loop_count=100):
     # perform a device inquiry on bluetooth device #0
     # The inquiry should last 8 * 1.28 = 10.24 seconds
     # before the inquiry is performed, bluez should flush its cache of
     # previously discovered devices
-    flt = bluez.hci_filter_new()
-    bluez.hci_filter_all_events(flt)
-    bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
-    sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
-    done = False
-    results = []
+    old_filter = hci_install_scan_filter(sock)
     myFullList = []
     for i in range(0, loop_count):
-        pkt = sock.recv(255)
-        ptype, event, plen = struct.unpack("BBB", pkt[:3])
-        #print "--------------"
-        if event == bluez.EVT_INQUIRY_RESULT_WITH_RSSI:
-            i =0
-        elif event == bluez.EVT_NUM_COMP_PKTS:
-            i =0
-        elif event == bluez.EVT_DISCONN_COMPLETE:
-            i =0
-        elif event == LE_META_EVENT:
-            subevent, = struct.unpack("B", pkt[3])
-            pkt = pkt[4:]
-            if subevent == EVT_LE_CONN_COMPLETE:
-                le_handle_connection_complete(pkt)
-            elif subevent == EVT_LE_ADVERTISING_REPORT:
-                #print "advertising report"
-                num_reports = struct.unpack("B", pkt[0])[0]
-                report_pkt_offset = 0
-                for i in range(0, num_reports):
-
-                    if (DEBUG == True):
-                        print "-------------"
-                        #print "\tfullpacket: ", printpacket(pkt)
-                        print "\tUDID: ", printpacket(pkt[report_pkt_offset -22: report_pkt_offset - 6])
-                        print "\tMAJOR: ", printpacket(pkt[report_pkt_offset -6: report_pkt_offset - 4])
-                        print "\tMINOR: ", printpacket(pkt[report_pkt_offset -4: report_pkt_offset - 2])
-                        print "\tMAC address: ", packed_bdaddr_to_string(pkt[report_pkt_offset + 3:report_pkt_offset + 9])
-                        # commented out - don't know what this byte is.  It's NOT TXPower
-                        txpower, = struct.unpack("b", pkt[report_pkt_offset -2])
-                        print "\t(Unknown):", txpower
-
-                        rssi, = struct.unpack("b", pkt[report_pkt_offset -1])
-                        print "\tRSSI:", rssi
-                    # build the return string
-                    Adstring = packed_bdaddr_to_string(pkt[report_pkt_offset + 3:report_pkt_offset + 9])
-                    Adstring += ","
-                    Adstring += returnstringpacket(pkt[report_pkt_offset -22: report_pkt_offset - 6])
-                    Adstring += ","
-                    Adstring += "%i" % returnnumberpacket(pkt[report_pkt_offset -6: report_pkt_offset - 4])
-                    Adstring += ","
-                    Adstring += "%i" % returnnumberpacket(pkt[report_pkt_offset -4: report_pkt_offset - 2])
-                    Adstring += ","
-                    Adstring += "%i" % struct.unpack("b", pkt[report_pkt_offset -2])
-                    Adstring += ","
-                    Adstring += "%i" % struct.unpack("b", pkt[report_pkt_offset -1])
-
-                    #print "\tAdstring=", Adstring
-                    myFullList.append(Adstring)
-                done = True
+        pkt = sock.recv(HCI_MAX_EVENT_SIZE)
+        myFullList.extend(parse_packet(pkt))
     sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, old_filter )
     return myFullList
+
+
+def listen(sock, duration, match=None, wanted=None):
+    """Yield the adverts heard on a scanning socket for a time window.
+
+    Each device is yielded once per window, however often it advertises, so
+    loud beacons can't crowd out quiet ones.  The scan filter must already
+    be installed (see hci_install_scan_filter()).
+
+    Arguments:
+    sock --- the HCI socket, with LE scanning enabled
+    duration --- how long to listen for (s)
+    match --- optional function returning a key for a wanted advert
+    wanted --- optional set of keys.  Listening stops early once match has
+               returned every one of them.
+
+    Yields:
+    Advert records
+    """
+    deadline = time.time() + duration
+    seen = set()
+    found = set()
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        readable, _, _ = select.select([sock], [], [], remaining)
+        if not readable:
+            return
+        for advert in parse_packet(sock.recv(HCI_MAX_EVENT_SIZE), seen):
+            yield advert
+            if match is not None and wanted:
+                key = match(advert)
+                if key in wanted:
+                    found.add(key)
+                    if len(found) == len(wanted):
+                        return
+
+
+class AdvertRing(object):
+    """A single producer, single consumer ring of adverts in shared memory.
+
+    The memory is an anonymous shared mapping, so it must be made before
+    the producer process is forked.  The producer only ever writes the head
+    and its counters, the consumer only the tail, so no lock is needed.
+    The counters are 32 bit and wrap, which is why size must be a power of
+    two.  Adverts that don't fit are dropped and counted, never blocking
+    the producer.
+    """
+
+    def __init__(self, size=4096):
+        if size & (size - 1):
+            raise ValueError('ring size must be a power of two')
+        self.size = size
+        self.buf = mmap.mmap(-1, RING_HEADER.size + size * RING_RECORD.size)
+        # Producer's copy of its counters
+        self.head = 0
+        self.packets = 0
+        self.dropped = 0
+        # Consumer's copy of its tail and the last counters it saw
+        self.tail = 0
+        self.seen_packets = 0
+        self.seen_dropped = 0
+
+    def put(self, adverts):
+        """Add the adverts from one packet (producer only)."""
+        tail = RING_HEADER.unpack_from(self.buf)[1]
+        head = self.head
+        for advert in adverts:
+            if (head - tail) & 0xffffffff >= self.size:
+                self.dropped = (self.dropped + 1) & 0xffffffff
+                continue
+            if advert.uuid is None:
+                record = (advert.mac, 0, '', 0, 0, 0, advert.rssi)
+            else:
+                record = (advert.mac, RING_IBEACON, advert.uuid,
+                          advert.major, advert.minor, advert.txpower,
+                          advert.rssi)
+            RING_RECORD.pack_into(self.buf, RING_HEADER.size
+                                  + (head & (self.size - 1))
+                                  * RING_RECORD.size, *record)
+            head = (head + 1) & 0xffffffff
+        self.head = head
+        self.packets = (self.packets + 1) & 0xffffffff
+        # Records are written before the head that makes them visible
+        struct.pack_into("<I", self.buf, 0, head)
+        struct.pack_into("<II", self.buf, 8, self.packets, self.dropped)
+
+    def get(self):
+        """Take every advert waiting (consumer only).
+
+        Returns:
+        (list of Advert records, packets read, adverts dropped) with the
+        counts being since the last get()
+        """
+        head, tail, packets, dropped = RING_HEADER.unpack_from(self.buf)
+        tail = self.tail
+        adverts = []
+        while tail != head:
+            mac, flags, uuid, major, minor, txpower, rssi = (
+                RING_RECORD.unpack_from(self.buf, RING_HEADER.size
+                                        + (tail & (self.size - 1))
+                                        * RING_RECORD.size))
+            if flags & RING_IBEACON:
+                adverts.append(Advert(mac, uuid, major, minor, txpower, rssi))
+            else:
+                adverts.append(Advert(mac, None, None, None, None, rssi))
+            tail = (tail + 1) & 0xffffffff
+        self.tail = tail
+        struct.pack_into("<I", self.buf, 4, tail)
+        counts = ((packets - self.seen_packets) & 0xffffffff,
+                  (dropped - self.seen_dropped) & 0xffffffff)
+        self.seen_packets, self.seen_dropped = packets, dropped
+        return adverts, counts[0], counts[1]
+
+    def close(self):
+        self.buf.close()
+
+
+def _ring_reader(sock, ring, wake_r, wake_w):
+    # The reader process: decode packets into the ring as fast as they come
+    # and poke the consumer through the pipe.  Exits when the socket fails
+    # or the parent goes away.
+    os.close(wake_r)
+    parent = os.getppid()
+    while os.getppid() == parent:
+        try:
+            readable, _, _ = select.select([sock], [], [], 1)
+            if not readable:
+                continue
+            pkt = sock.recv(HCI_MAX_EVENT_SIZE)
+        except (IOError, select.error, bluez.error):
+            return
+        ring.put(parse_packet(pkt))
+        try:
+            os.write(wake_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                return
+
+
+class RingReader(object):
+    """Read an HCI socket in a separate process, through an AdvertRing.
+
+    The reader process does nothing but receive and decode packets, so the
+    adapter is drained promptly even while the main process is busy.
+    fileno() becomes readable when adverts are waiting, and read() returns
+    all of them at once.  When the reader process stops, because the socket
+    failed, read() raises IOError.
+    """
+
+    def __init__(self, sock, size=4096):
+        self.ring = AdvertRing(size)
+        self.wake_r, wake_w = os.pipe()
+        flags = fcntl.fcntl(wake_w, fcntl.F_GETFL)
+        fcntl.fcntl(wake_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.process = multiprocessing.Process(
+            target=_ring_reader, args=(sock, self.ring, self.wake_r, wake_w),
+            name='HCIReader')
+        self.process.daemon = True
+        try:
+            self.process.start()
+        finally:
+            os.close(wake_w)
+
+    def fileno(self):
+        return self.wake_r
+
+    def read(self):
+        """Return (adverts, packets read, adverts dropped) since last time."""
+        if not os.read(self.wake_r, 4096):
+            raise IOError('HCI reader process stopped')
+        return self.ring.get()
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        os.close(self.wake_r)
+        self.ring.close()
+
+
+class LEScanner(object):
+    """A long lived LE scan on one HCI device.
+
+    The socket is opened, filtered and put into scanning mode once by open()
+    and stays that way until close(), so advertising reports can be read as
+    they arrive instead of in short bursts.  fileno() makes the scanner
+    usable with select().
+
+    With filter_duplicates the controller only reports each device once,
+    which saves a lot of wakeups with many chatty beacons.  To still get RSSI
+    updates the scan is restarted, clearing the controller's duplicate list,
+    every duplicate_reset seconds; callers do this by calling
+    reset_duplicates() once next_duplicate_reset has passed.
+
+    With reader_process the socket is read by a RingReader, and read()
+    returns every advert that has arrived since the last call.
+
+    active, interval, window and own_type are the scan parameters, see
+    hci_le_set_scan_parameters().  set_window() changes the scan window of
+    an open scan, to trade how quickly beacons are heard for power and
+    airtime.
+
+    open_dev is the function used to open the HCI socket, so a stand in
+    such as replay.ReplaySocket can be used instead of a real adapter.
+    """
+
+    def __init__(self, dev_id=0, filter_duplicates=False, duplicate_reset=5,
+                 open_dev=bluez.hci_open_dev, reader_process=False,
+                 ring_size=4096, active=False, interval=10, window=10,
+                 own_type=LE_PUBLIC_ADDRESS):
+        self.dev_id = dev_id
+        self.open_dev = open_dev
+        self.filter_duplicates = filter_duplicates
+        self.duplicate_reset = duplicate_reset
+        self.reader_process = reader_process
+        self.ring_size = ring_size
+        self.active = active
+        self.interval = interval
+        self.full_window = window
+        self.window = window
+        self.own_type = own_type
+        self.next_duplicate_reset = None
+        self.sock = None
+        self.old_filter = None
+        self.reader = None
+
+    def open(self):
+        sock = self.open_dev(self.dev_id)
+        try:
+            self.old_filter = hci_install_scan_filter(sock)
+            # Parameters can't be changed while another scan is running
+            hci_disable_le_scan(sock)
+            self.window = self.full_window
+            hci_le_set_scan_parameters(sock, self.active, self.interval,
+                                       self.window, self.own_type)
+            hci_enable_le_scan(sock, int(self.filter_duplicates))
+            if self.reader_process:
+                self.reader = RingReader(sock, self.ring_size)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        self.scan_mark = time.time()
+        if self.filter_duplicates:
+            self.next_duplicate_reset = time.time() + self.duplicate_reset
+
+    def reset_duplicates(self):
+        """Restart the scan so already reported devices are reported again."""
+        hci_disable_le_scan(self.sock)
+        hci_enable_le_scan(self.sock, 0x01)
+        self.next_duplicate_reset = time.time() + self.duplicate_reset
+
+    def set_window(self, window):
+        """Restart the scan with a new scan window (ms)."""
+        self._count_scan_time()
+        hci_disable_le_scan(self.sock)
+        hci_le_set_scan_parameters(self.sock, self.active, self.interval,
+                                   window, self.own_type)
+        hci_enable_le_scan(self.sock, int(self.filter_duplicates))
+        self.window = window
+
+    def close(self):
+        if self.sock is None:
+            return
+        self._count_scan_time()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        try:
+            hci_disable_le_scan(self.sock)
+            self.sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER,
+                                  self.old_filter )
+        except:
+            pass
+        self.sock.close()
+        self.sock = None
+        self.next_duplicate_reset = None
+
+    def _count_scan_time(self):
+        # The radio only listens for window out of every interval
+        now = time.time()
+        scan_seconds.inc((now - self.scan_mark) * self.window / self.interval)
+        self.scan_mark = now
+
+    def fileno(self):
+        if self.reader is not None:
+            return self.reader.fileno()
+        return self.sock.fileno()
+
+    def read(self):
+        """Read one packet and return the adverts it carried.
+
+        With reader_process, return every advert waiting instead.
+        """
+        if self.reader is not None:
+            adverts, packets, dropped = self.reader.read()
+            if dropped:
+                ring_dropped.inc(dropped)
+        else:
+            adverts = parse_packet(self.sock.recv(HCI_MAX_EVENT_SIZE))
+            packets = 1
+        self._count_scan_time()
+        hci_packets.inc(packets)
+        decoded_adverts.inc(len(adverts))
+        return adverts
@@ -0,0 +1,221 @@
+"""The devices the scanner is looking for."""
+
+import binascii
+import blescan
+
+# Device kinds, as set in Vera's DeviceType variable
+BEACON = 'ibeacon'
+PHONE = 'bluetooth'
+
+
+def parse_beacon_address(address):
+    """Turn a beacon address from Vera into a binary lookup key.
+
+    Arguments:
+    address --- 'AA:BB:CC:DD:EE:FF' for a MAC address, or
+                'UUID,major,minor' for an iBeacon.  The minor, or the major
+                and minor, may be given as '*' or left out to match any
+                value.
+
+    Returns:
+    (kind, key) where kind is 'mac', 'minor', 'major' or 'uuid' and key is
+    the packed address, (uuid, major, minor), (uuid, major) or uuid
+    respectively.  None if the address can't be parsed.
+    """
+    try:
+        if ',' not in address and address.count(':') == 5:
+            return 'mac', blescan.get_packed_bdaddr(address)
+        parts = address.split(',')
+        uuid = binascii.unhexlify(parts[0].replace('-', ''))
+        if len(uuid) != 16 or len(parts) > 3:
+            return None
+        parts = [p.strip() for p in parts[1:]]
+        while parts and parts[-1] == '*':
+            parts.pop()
+        if not parts:
+            return 'uuid', uuid
+        if len(parts) == 1:
+            return 'major', (uuid, int(parts[0]))
+        return 'minor', (uuid, int(parts[0]), int(parts[1]))
+    except (ValueError, TypeError):
+        return None
+
+
+class Device(object):
+    """A device the scanner is looking for.
+
+    Arguments:
+    num --- the device's slot in its DeviceRegistry
+    id --- the Vera device id as a string
+    address --- the address as configured in Vera, upper case
+    kind --- BEACON or PHONE
+    key --- the parsed lookup key, see parse_beacon_address()
+    """
+
+    __slots__ = ('num', 'id', 'address', 'kind', 'key', 'last_state',
+                 'last_seen', 'last_report', 'next_poll', 'expiry', 'rssi',
+                 'reported_rssi', 'misses')
+
+    def __init__(self, num, id, address, kind, key):
+        self.num = num
+        self.id = id
+        self.address = address
+        self.kind = kind
+        self.key = key
+        self.last_state = False
+        self.last_seen = 0
+        self.last_report = 0
+        self.next_poll = 0
+        self.expiry = None
+        self.rssi = None
+        self.reported_rssi = None
+        self.misses = 0
+
+    def update_rssi(self, rssi, alpha):
+        """Fold a new RSSI reading into the smoothed RSSI.
+
+        Arguments:
+        rssi --- the new reading
+        alpha --- the weight of the new reading, from 0 to 1 (no smoothing)
+        """
+        if self.rssi is None:
+            self.rssi = float(rssi)
+        else:
+            self.rssi += alpha * (rssi - self.rssi)
+
+    def needs_report(self, now, min_idle, delta, keepalive):
+        """Decide whether Vera should be told about this device.
+
+        A device that has not been reported since it became present is
+        always reported.  Otherwise it is reported when the smoothed RSSI has
+        moved at least delta from the last reported value, but not more
+        often than every min_idle seconds, or after keepalive seconds
+        regardless.
+        """
+        if self.reported_rssi is None:
+            return True
+        idle = now - self.last_report
+        if idle >= keepalive:
+            return True
+        return (idle >= min_idle
+                and abs(self.rssi - self.reported_rssi) >= delta)
+
+    def reported(self, now):
+        """Note that the device's current RSSI has been sent to Vera."""
+        self.last_report = now
+        self.reported_rssi = self.rssi
+
+    def absent(self):
+        """Mark the device as not present."""
+        self.last_state = False
+        self.rssi = None
+        self.reported_rssi = None
+        self.misses = 0
+
+
+class DeviceRegistry(object):
+    """All the devices the scanner is looking for.
+
+    Devices live in a list indexed by their num, with freed slots reused, and
+    are indexed by address for phones and by binary key for beacons.  Beacon
+    keys are parsed once when a device is added, so matching an advert is a
+    handful of hash lookups with no string formatting.  More specific rules
+    win: MAC, then UUID/major/minor, then UUID/major, then UUID on its own.
+    """
+
+    def __init__(self):
+        self.devices = []
+        self.free = []
+        self.beacons = {}
+        self.phones = {}
+        self.by_mac = {}
+        self.by_minor = {}
+        self.by_major = {}
+        self.by_uuid = {}
+        self.tables = {
+            'mac': self.by_mac,
+            'minor': self.by_minor,
+            'major': self.by_major,
+            'uuid': self.by_uuid,
+            }
+
+    def __len__(self):
+        return len(self.beacons) + len(self.phones)
+
+    def __iter__(self):
+        for device in self.devices:
+            if device is not None:
+                yield device
+
+    def find(self, kind, address):
+        """Return the device of a kind with an address, or None."""
+        if kind == BEACON:
+            return self.beacons.get(address)
+        return self.phones.get(address)
+
+    def add(self, id, address, kind):
+        """Add a device.
+
+        Returns:
+        the new Device, or None if a beacon address can't be parsed
+        """
+        if kind == BEACON:
+            parsed = parse_beacon_address(address)
+            if parsed is None:
+                return None
+        else:
+            parsed = None
+        if self.free:
+            num = self.free.pop()
+        else:
+            num = len(self.devices)
+            self.devices.append(None)
+        device = Device(num, id, address, kind, parsed)
+        self.devices[num] = device
+        if kind == BEACON:
+            self.beacons[address] = device
+            self.tables[parsed[0]][parsed[1]] = device
+        else:
+            self.phones[address] = device
+        return device
+
+    def remove(self, device):
+        self.devices[device.num] = None
+        self.free.append(device.num)
+        if device.kind == BEACON:
+            del self.beacons[device.address]
+            table = self.tables[device.key[0]]
+            if table.get(device.key[1]) is device:
+                del table[device.key[1]]
+        else:
+            del self.phones[device.address]
+
+    def match(self, advert):
+        """Return the beacon Device for a blescan.Advert, or None."""
+        device = self.by_mac.get(advert.mac)
+        if device is not None or advert.uuid is None:
+            return device
+        device = self.by_minor.get((advert.uuid, advert.major, advert.minor))
+        if device is not None:
+            return device
+        if self.by_major:
+            device = self.by_major.get((advert.uuid, advert.major))
+            if device is not None:
+                return device
+        if self.by_uuid:
+            return self.by_uuid.get(advert.uuid)
+        return None
+
+    def expire(self, kind, cutoff):
+        """Mark present devices of a kind not seen since cutoff as absent.
+
+        Returns:
+        list of the devices marked absent
+        """
+        expired = []
+        for device in self.devices:
+            if (device is not None and device.kind == kind
+                    and device.last_state and device.last_seen < cutoff):
+                device.absent()
+                expired.append(device)
+        return expired
@@ -1,26 +1,185 @@
 #!/usr/bin/env python
+"""List the bluetooth LE devices advertising nearby.
 
+By default every device heard in 5 seconds is printed once as
+mac,uuid,major,minor,txpower,rssi.  With --discover the scan keeps running
+and a table of the devices heard, closest first, is refreshed every second
+until interrupted, which makes it easy to pick out a new beacon by bringing
+it near the scanner.
+"""
+
+import argparse
+import collections
+import select
 import sys
+import time
 import bluetooth
 import bluetooth._bluetooth as bluez
 import blescan
 
 
+class DeviceStats(object):
+    """What has been heard from one advertising device."""
+
+    __slots__ = ('mac', 'uuid', 'major', 'minor', 'count', 'rssi',
+                 'rssi_total', 'max_rssi', 'last_seen')
+
+    def __init__(self, advert):
+        self.mac = advert.mac
+        self.uuid = advert.uuid
+        self.major = advert.major
+        self.minor = advert.minor
+        self.count = 0
+        self.rssi = None
+        self.rssi_total = 0
+        self.max_rssi = advert.rssi
+        self.last_seen = 0
+
+    def add(self, advert, now, alpha):
+        """Count an advert heard from the device.
+
+        Arguments:
+        advert --- the Advert heard
+        now --- when it was heard
+        alpha --- the weight of its RSSI in the smoothed RSSI
+        """
+        if advert.uuid is not None:
+            self.uuid = advert.uuid
+            self.major = advert.major
+            self.minor = advert.minor
+        self.count += 1
+        if self.rssi is None:
+            self.rssi = float(advert.rssi)
+        else:
+            self.rssi += alpha * (advert.rssi - self.rssi)
+        self.rssi_total += advert.rssi
+        self.max_rssi = max(self.max_rssi, advert.rssi)
+        self.last_seen = now
+
+    def mean_rssi(self):
+        return float(self.rssi_total) / self.count
+
+    def vera_address(self):
+        """The address to give the device's Presence Sensor in Vera."""
+        if self.uuid is None:
+            return blescan.packed_bdaddr_to_string(self.mac).upper()
+        return '%s,%d,%d' % (self.uuid.encode('hex').upper(), self.major,
+                             self.minor)
+
+
+class DeviceTable(object):
+    """Stats for the most recently heard devices.
+
+    At most size devices are kept; the one heard least recently makes way
+    for a new one, so memory stays bounded however long the scan runs.
+    Devices are ordered by their smoothed RSSI, where each new reading has
+    weight alpha, so a beacon being moved shows where it is now rather than
+    where it has been.
+    """
+
+    def __init__(self, size=256, alpha=0.3):
+        self.size = size
+        self.alpha = alpha
+        self.devices = collections.OrderedDict()
+
+    def add(self, advert, now):
+        stats = self.devices.pop(advert.mac, None)
+        if stats is None:
+            stats = DeviceStats(advert)
+            if len(self.devices) >= self.size:
+                self.devices.popitem(last=False)
+        stats.add(advert, now, self.alpha)
+        self.devices[advert.mac] = stats
+
+    def closest(self, count):
+        """Return the stats of up to count devices, loudest now first."""
+        return sorted(self.devices.itervalues(),
+                      key=lambda stats: stats.rssi, reverse=True)[:count]
+
+
+def format_table(table, rows, vera, now):
+    lines = ['%-17s %-32s %5s %5s %6s %5s %5s %4s %5s%s' % (
+        'MAC', 'UUID', 'MAJOR', 'MINOR', 'COUNT', 'RSSI', 'MEAN', 'MAX', 'AGE',
+        '  VERA ADDRESS' if vera else '')]
+    for stats in table.closest(rows):
+        if stats.uuid is None:
+            ibeacon = '%-32s %5s %5s' % ('', '', '')
+        else:
+            ibeacon = '%-32s %5d %5d' % (stats.uuid.encode('hex'),
+                                         stats.major, stats.minor)
+        lines.append('%-17s %s %6d %5.0f %5.0f %4d %4.0fs%s' % (
+            blescan.packed_bdaddr_to_string(stats.mac), ibeacon, stats.count,
+            stats.rssi, stats.mean_rssi(), stats.max_rssi,
+            now - stats.last_seen,
+            '  ' + stats.vera_address() if vera else ''))
+    return '\n'.join(lines)
+
+
+def discover(args):
+    """Scan until interrupted, showing the closest devices."""
+    scanner = blescan.LEScanner(args.device)
+    try:
+        scanner.open()
+    except:
+        print("Error accessing bluetooth device for beacon scan")
+        return 1
+    table = DeviceTable(args.table_size, args.smoothing)
+    clear = '\x1b[2J\x1b[H' if sys.stdout.isatty() else '\n'
+    next_refresh = time.time()
+    try:
+        while True:
+            timeout = max(next_refresh - time.time(), 0)
+            readable, _, _ = select.select([scanner], [], [], timeout)
+            now = time.time()
+            if readable:
+                for advert in scanner.read():
+                    table.add(advert, now)
+            if now >= next_refresh:
+                sys.stdout.write(clear + format_table(table, args.rows,
+                                                      args.vera, now) + '\n')
+                sys.stdout.flush()
+                next_refresh = now + args.refresh
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scanner.close()
+    return 0
+
+
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--device', type=int, default=0,
+                        help='hci number of the adapter (default 0)')
+    parser.add_argument('--discover', action='store_true',
+                        help='keep scanning and show the closest devices')
+    parser.add_argument('--refresh', type=float, default=1.0,
+                        help='seconds between updates of the table')
+    parser.add_argument('--rows', type=int, default=20,
+                        help='devices shown in the table (default 20)')
+    parser.add_argument('--table-size', type=int, default=256,
+                        help='most devices remembered (default 256)')
+    parser.add_argument('--smoothing', type=float, default=0.3,
+                        help='weight of each new RSSI reading in the order '
+                        'of the table (1 = no smoothing, default 0.3)')
+    parser.add_argument('--vera', action='store_true',
+                        help='show the address to enter in Vera')
+    args = parser.parse_args()
+    if args.discover:
+        return discover(args)
+
     try:
-        sock = bluez.hci_open_dev()
+        sock = bluez.hci_open_dev(args.device)
         blescan.hci_le_set_scan_parameters(sock)
         blescan.hci_enable_le_scan(sock)
     except:
         print("Error accessing bluetooth device for beacon scan")
         return 1
-    sock.settimeout(5)
-    returnedList = blescan.parse_events(sock, 20)
+    old_filter = blescan.hci_install_scan_filter(sock)
+    for advert in blescan.listen(sock, 5):
+        print(blescan.format_advert(advert))
+    sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, old_filter)
     sock.close()
 
-    for address in returnedList:
-        print(address)
-
 if __name__ == '__main__':
     ret_val = main()
     sys.exit(ret_val)
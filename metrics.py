@@ -0,0 +1,162 @@
+"""Counters and latency histograms for the scanner's hot paths.
+
+Modules create their metrics once at import with counter() or histogram()
+and update them as they go.  serve() exposes every metric in the Prometheus
+text format over HTTP, and Summary gives a one line overview for the log.
+"""
+
+import bisect
+import BaseHTTPServer
+import threading
+import time
+
+# Latency buckets (s), from sub millisecond decoding to multi second pages
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+_lock = threading.Lock()
+
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with _lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            samples.append(('%s_bucket{le="%g"}' % (self.name, bound),
+                            cumulative))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, count))
+        samples.append(('%s_sum' % self.name, total))
+        samples.append(('%s_count' % self.name, count))
+        return samples
+
+
+def _add(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def counter(name, help):
+    return _add(Counter(name, help))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    return _add(Histogram(name, help, buckets))
+
+
+def exposition():
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append('%s %r' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(address, port):
+    """Serve the metrics over HTTP from a background thread."""
+    server = BaseHTTPServer.HTTPServer((address, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name='Metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Summary(object):
+    """One line summaries of the counters and histograms since last time."""
+
+    def __init__(self):
+        self.last = time.time()
+        self.values = {}
+
+    def summary(self):
+        now = time.time()
+        elapsed = max(now - self.last, 1e-9)
+        parts = []
+        for metric in _metrics:
+            if metric.kind == 'counter':
+                change = metric.value - self.values.get(metric.name, 0)
+                self.values[metric.name] = metric.value
+                parts.append('%s=%.1f/s' % (metric.name, change / elapsed))
+            else:
+                count = metric.count - self.values.get(metric.name, 0)
+                total = metric.sum - self.values.get(metric.name + '_sum', 0)
+                self.values[metric.name] = metric.count
+                self.values[metric.name + '_sum'] = metric.sum
+                if count:
+                    parts.append('%s=%.1fms' % (metric.name,
+                                                total / count * 1000))
+        self.last = now
+        return ' '.join(parts)
+
+
+def log_summaries(logger, period):
+    """Log a Summary every period seconds from a background thread."""
+
+    def run():
+        summary = Summary()
+        while True:
+            time.sleep(period)
+            logger.info('Metrics: %s' % summary.summary())
+
+    thread = threading.Thread(target=run, name='MetricsLog')
+    thread.daemon = True
+    thread.start()
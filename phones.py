@@ -0,0 +1,315 @@
+"""Polling Classic Bluetooth phones without holding up the main loop."""
+
+import array
+import fcntl
+import heapq
+import logging
+import os
+import Queue
+import struct
+import threading
+import time
+import bluetooth
+import bluetooth._bluetooth as bluez
+import metrics
+
+logger = logging.getLogger('Bluetooth Scanner')
+
+probe_latency = metrics.histogram('phone_probe_seconds',
+                                  'Time taken to poll a phone')
+probe_failures = metrics.counter('phone_probe_failures_total',
+                                 'Phone polls that got no answer')
+probes_skipped = metrics.counter('phone_probes_skipped_total',
+                                 'Phone polls skipped as not needed')
+budget_waits = metrics.counter('phone_budget_waits_total',
+                               'Phone polls held back by the airtime budget')
+
+# L2CAP PSM of the SDP server, which every phone answers on
+SDP_PSM = 0x0001
+
+# Result given instead of an RSSI for a poll the skip function turned down
+SKIPPED = 'skipped'
+# How many seconds of unused airtime the budget can save up, as a multiple of
+# the budget (e.g. 0.25 of the radio saves up to 15s of polling)
+BUDGET_BURST = 60
+
+
+class PhonePoller(object):
+    """Probe phones from a pool of worker threads in deadline order.
+
+    Each phone has a next poll deadline kept in a heap; workers take the
+    earliest due phone, probe it and queue the result.  A phone is never
+    probed by two workers at once; the caller schedules the next probe when
+    it handles the result.  fileno() becomes readable when there are
+    results, so the poller can be used with select().
+
+    Paging a phone that is not there ties up the radio for the whole page
+    timeout, so the time spent probing can be limited to a fraction of the
+    time (the budget).  Probes that would go over it wait for the budget to
+    build up again.
+    """
+
+    def __init__(self, probe, workers=1, skip=None, budget=None):
+        """
+        Arguments:
+        probe --- function taking an address, returning its RSSI or None
+        workers --- how many phones may be probed at the same time
+        skip --- function taking an address, true if a due probe isn't
+                 needed, in which case SKIPPED is given as its result
+        budget --- fraction of the time that may be spent probing, None for
+                   no limit
+        """
+        self.probe = probe
+        self.workers = workers
+        self.skip = skip
+        self.budget = budget
+        self.airtime = budget * BUDGET_BURST if budget else 0
+        self.airtime_time = time.time()
+        self.heap = []
+        self.deadlines = {}
+        self.in_flight = set()
+        self.cond = threading.Condition()
+        self.results = Queue.Queue()
+        self.wake_r, self.wake_w = os.pipe()
+
+    def start(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work,
+                                      name='PhonePoller-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def fileno(self):
+        return self.wake_r
+
+    def schedule(self, address, deadline):
+        """Set when a phone should next be probed."""
+        with self.cond:
+            self.deadlines[address] = deadline
+            heapq.heappush(self.heap, (deadline, address))
+            self.cond.notify()
+
+    def remove(self, address):
+        """Stop probing a phone."""
+        with self.cond:
+            self.deadlines.pop(address, None)
+
+    def sync(self, addresses):
+        """Probe exactly the given phones, new ones straight away.
+
+        Phones being probed right now are left for the caller to schedule
+        again when their result comes in.
+        """
+        with self.cond:
+            for address in self.deadlines.keys():
+                if address not in addresses:
+                    del self.deadlines[address]
+            for address in addresses:
+                if (address not in self.deadlines
+                        and address not in self.in_flight):
+                    self.deadlines[address] = 0
+                    heapq.heappush(self.heap, (0, address))
+            self.cond.notify_all()
+
+    def get_results(self):
+        """Return the (address, RSSI, time) results ready so far."""
+        os.read(self.wake_r, 4096)
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def _next(self):
+        # Wait for the earliest due phone and the airtime to probe it,
+        # unless it is to be skipped.  Heap entries that no longer match
+        # deadlines are stale and dropped.
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.heap:
+                    deadline, address = self.heap[0]
+                    if self.deadlines.get(address) != deadline:
+                        heapq.heappop(self.heap)
+                        continue
+                    break
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, address = self.heap[0]
+                if deadline > now:
+                    self.cond.wait(deadline - now)
+                    continue
+                skipped = self.skip is not None and self.skip(address)
+                if self.budget and not skipped:
+                    self.airtime = min(
+                        self.airtime + (now - self.airtime_time)
+                        * self.budget, self.budget * BUDGET_BURST)
+                    self.airtime_time = now
+                    if self.airtime <= 0:
+                        budget_waits.inc()
+                        self.cond.wait(-self.airtime / self.budget)
+                        continue
+                heapq.heappop(self.heap)
+                del self.deadlines[address]
+                self.in_flight.add(address)
+                return address, skipped
+
+    def _work(self):
+        while True:
+            address, skipped = self._next()
+            if skipped:
+                probes_skipped.inc()
+                self._finish(address, SKIPPED, 0)
+                continue
+            start = time.time()
+            try:
+                rssi = self.probe(address)
+            except Exception, e:
+                logger.debug('Error polling bluetooth %s: %s' % (address, e))
+                rssi = None
+            elapsed = time.time() - start
+            probe_latency.observe(elapsed)
+            if rssi is None:
+                probe_failures.inc()
+            self._finish(address, rssi, elapsed)
+
+    def _finish(self, address, rssi, airtime):
+        with self.cond:
+            self.in_flight.discard(address)
+            self.airtime -= airtime
+        self.results.put((address, rssi, time.time()))
+        os.write(self.wake_w, 'x')
+
+
+class PhoneConnections(object):
+    """Read phone RSSI, keeping the links to present phones open.
+
+    One HCI control socket is shared by all polls.  The first successful poll
+    of a phone pages it with an L2CAP connect to its SDP server, bound to
+    the adapter's address so the page goes out on that adapter, and the
+    socket is kept open, which keeps the ACL link up.  Later polls only
+    check that the link still has the same connection handle (controllers
+    reuse handles, so a new link to another phone could have it) and send
+    an HCI Read RSSI command on it.  A link is only paged again when either
+    fails, i.e. once the phone has gone away.
+    """
+
+    def __init__(self, dev_id=0):
+        self.dev_id = dev_id
+        self.bdaddr = None
+        self.hci_sock = None
+        self.hci_lock = threading.Lock()
+        self.links = {}
+        self.links_lock = threading.Lock()
+
+    def close(self):
+        with self.links_lock:
+            for address in self.links.keys():
+                self._drop(address)
+        with self.hci_lock:
+            if self.hci_sock is not None:
+                self.hci_sock.close()
+                self.hci_sock = None
+
+    def prune(self, addresses):
+        """Close the links to phones that are no longer known."""
+        with self.links_lock:
+            for address in self.links.keys():
+                if address not in addresses:
+                    self._drop(address)
+
+    def _drop(self, address):
+        link, handle = self.links.pop(address)
+        try:
+            link.close()
+        except:
+            pass
+
+    def _local_address(self):
+        # The adapter's own address, for binding the links to it
+        if self.bdaddr is None:
+            with self.hci_lock:
+                if self.hci_sock is None:
+                    self.hci_sock = bluez.hci_open_dev(self.dev_id)
+                reply = bluez.hci_send_req(self.hci_sock,
+                                           bluez.OGF_INFO_PARAM,
+                                           bluez.OCF_READ_BD_ADDR,
+                                           bluez.EVT_CMD_COMPLETE, 7)
+            status, bdaddr = struct.unpack('<B6s', reply)
+            if status != 0:
+                raise IOError('Failed to read address of hci%d'
+                              % self.dev_id)
+            self.bdaddr = bluez.ba2str(bdaddr)
+        return self.bdaddr
+
+    def _connection_handle(self, address):
+        # Get handle to ACL connection to remote BT device.  Raises IOError
+        # if there is no connection.
+        reqstr = struct.pack ("6sB17s", bluez.str2ba (address),
+                bluez.ACL_LINK, "\0" * 17)
+        request = array.array ("c", reqstr)
+        with self.hci_lock:
+            if self.hci_sock is None:
+                self.hci_sock = bluez.hci_open_dev(self.dev_id)
+            fcntl.ioctl (self.hci_sock.fileno(), bluez.HCIGETCONNINFO,
+                         request, 1)
+        return struct.unpack ("8xH14x", request.tostring ())[0]
+
+    def _read_rssi(self, handle):
+        # Returns the RSSI of a connection, or None if the controller
+        # rejected the handle
+        cmd_pkt = struct.pack('<H', handle)
+        with self.hci_lock:
+            if self.hci_sock is None:
+                self.hci_sock = bluez.hci_open_dev(self.dev_id)
+            try:
+                reply = bluez.hci_send_req(self.hci_sock,
+                                           bluez.OGF_STATUS_PARAM,
+                                           bluez.OCF_READ_RSSI,
+                                           bluez.EVT_CMD_COMPLETE, 4,
+                                           cmd_pkt)
+            except bluez.error:
+                self.hci_sock.close()
+                self.hci_sock = None
+                raise
+        status, rssi = struct.unpack('<B2xb', reply)
+        if status != 0:
+            return None
+        return rssi
+
+    def get_RSSI(self, address):
+        """Return a phone's RSSI, or None if it can't be reached."""
+        with self.links_lock:
+            link = self.links.get(address)
+        if link is not None:
+            try:
+                if self._connection_handle(address) == link[1]:
+                    rssi = self._read_rssi(link[1])
+                    if rssi is not None:
+                        return rssi
+            except IOError:
+                pass
+            with self.links_lock:
+                if self.links.get(address) is link:
+                    self._drop(address)
+
+        # Try to open a connection to remote BT device from our adapter
+        sock = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+        try:
+            sock.bind((self._local_address(), 0))
+            sock.connect((address, SDP_PSM))
+            handle = self._connection_handle(address)
+            rssi = self._read_rssi(handle)
+        except:
+            sock.close()
+            return None
+        if rssi is None:
+            sock.close()
+            return None
+        with self.links_lock:
+            if address in self.links:
+                self._drop(address)
+            self.links[address] = (sock, handle)
+        return rssi
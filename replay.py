@@ -0,0 +1,213 @@
+"""Stand ins for the bluetooth adapter and Vera, for running off a Pi.
+
+ReplaySocket plays HCI event packets, for example from a btsnoop capture
+(hcidump -w or btmon -w), to anything expecting an HCI socket.  FakeVera
+is a minimal luup request server that serves a device list (which never
+changes) and records the actions sent to it.
+"""
+
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import struct
+import threading
+import time
+import urlparse
+
+HCI_EVENT_PKT = 0x04
+LE_META_EVENT = 0x3e
+EVT_LE_ADVERTISING_REPORT = 0x02
+
+BTSNOOP_MAGIC = 'btsnoop\0'
+BTSNOOP_HEADER = struct.Struct('>8sII')  # magic, version, datalink
+BTSNOOP_RECORD = struct.Struct('>IIIIq')  # orig, incl, flags, drops, time
+BTSNOOP_H4 = 1002  # packets start with their H4 type byte
+BTSNOOP_HCI = 1001  # packet type only given by the flags
+BTSNOOP_RECEIVED = 0x01  # flag: controller to host
+BTSNOOP_EVENT = 0x02  # flag: command or event
+
+
+def read_btsnoop(path):
+    """Read the HCI event packets from a btsnoop file.
+
+    Returns:
+    list of (timestamp in seconds, packet) with packets as they would be
+    read from an HCI socket
+    """
+    packets = []
+    with open(path, 'rb') as fp:
+        magic, version, datalink = BTSNOOP_HEADER.unpack(
+            fp.read(BTSNOOP_HEADER.size))
+        if magic != BTSNOOP_MAGIC or datalink not in (BTSNOOP_H4,
+                                                      BTSNOOP_HCI):
+            raise ValueError('%s is not a btsnoop HCI capture' % path)
+        while True:
+            header = fp.read(BTSNOOP_RECORD.size)
+            if len(header) < BTSNOOP_RECORD.size:
+                break
+            orig_len, incl_len, flags, drops, stamp = (
+                BTSNOOP_RECORD.unpack(header))
+            data = fp.read(incl_len)
+            if datalink == BTSNOOP_HCI:
+                if flags != BTSNOOP_RECEIVED | BTSNOOP_EVENT:
+                    continue
+                data = chr(HCI_EVENT_PKT) + data
+            elif not data or ord(data[0]) != HCI_EVENT_PKT:
+                continue
+            packets.append((stamp / 1000000.0, data))
+    return packets
+
+
+def write_btsnoop(path, packets):
+    """Write HCI event packets (H4 framed) to a btsnoop file.
+
+    Arguments:
+    packets --- list of (timestamp in seconds, packet)
+    """
+    with open(path, 'wb') as fp:
+        fp.write(BTSNOOP_HEADER.pack(BTSNOOP_MAGIC, 1, BTSNOOP_H4))
+        for stamp, data in packets:
+            fp.write(BTSNOOP_RECORD.pack(
+                len(data), len(data), BTSNOOP_RECEIVED | BTSNOOP_EVENT, 0,
+                int(stamp * 1000000)))
+            fp.write(data)
+
+
+def advert_packet(reports):
+    """Build an LE advertising report event.
+
+    Arguments:
+    reports --- list of (packed mac, AD data, rssi)
+    """
+    body = chr(EVT_LE_ADVERTISING_REPORT) + chr(len(reports))
+    for mac, data, rssi in reports:
+        body += struct.pack('<BB6sB', 0, 0, mac, len(data))
+        body += data + struct.pack('<b', rssi)
+    return struct.pack('<BBB', HCI_EVENT_PKT, LE_META_EVENT, len(body)) + body
+
+
+def ibeacon_data(uuid, major, minor, txpower=-59):
+    """Build the AD data of an iBeacon advert."""
+    return ('\x02\x01\x06\x1a\xff\x4c\x00\x02\x15'
+            + uuid + struct.pack('>HHb', major, minor, txpower))
+
+
+class ReplaySocket(object):
+    """An HCI socket stand in that replays captured packets.
+
+    Packets are fed from a thread through a socket pair, so fileno() works
+    with select() just like a real HCI socket.  With realtime the original
+    gaps between packets are kept, otherwise they are sent as fast as they
+    are read.  sent records (time, packet) of everything fed, and commands
+    the (ogf, ocf, params) of the HCI commands sent to the socket.
+    """
+
+    def __init__(self, packets, realtime=False):
+        self.packets = packets
+        self.realtime = realtime
+        self.sent = []
+        self.commands = []
+        self.hci_filter = ''
+        self.sock, self.feed = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_SEQPACKET)
+        self.finished = threading.Event()
+        feeder = threading.Thread(target=self._feed, name='ReplaySocket')
+        feeder.daemon = True
+        feeder.start()
+
+    def _feed(self):
+        start = time.time()
+        first = self.packets[0][0] if self.packets else 0
+        try:
+            for stamp, pkt in self.packets:
+                if self.realtime:
+                    delay = start + stamp - first - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.sent.append((time.time(), pkt))
+                self.feed.sendall(pkt)
+        except socket.error:
+            pass
+        self.finished.set()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def getsockopt(self, level, option, size):
+        return self.hci_filter
+
+    def setsockopt(self, level, option, value):
+        self.hci_filter = value
+
+    def send_cmd(self, ogf, ocf, params):
+        self.commands.append((ogf, ocf, params))
+
+    def close(self):
+        self.sock.close()
+        self.feed.close()
+
+
+class FakeVera(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A luup request server on localhost serving a fixed user_data.
+
+    actions records (time, query dict) of every data_request?id=action.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, user_data, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           _FakeVeraHandler)
+        self.user_data = json.dumps(user_data)
+        self.status = json.dumps({'DataVersion': user_data['DataVersion'],
+                                  'LoadTime': user_data['LoadTime'],
+                                  'devices': []})
+        self.data_version = str(user_data['DataVersion'])
+        self.load_time = str(user_data['LoadTime'])
+        self.actions = []
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='FakeVera')
+        thread.daemon = True
+        thread.start()
+
+
+class _FakeVeraHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each reply in one go, so timings aren't skewed by Nagle
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if query.get('id') == 'user_data':
+            if query.get('DataVersion') == self.server.data_version:
+                body = 'NO_CHANGES'
+            else:
+                body = self.server.user_data
+        elif query.get('id') == 'status':
+            # Nothing changes, so only a stale LoadTime gets a reply early
+            if query.get('LoadTime') == self.server.load_time:
+                time.sleep(float(query.get('Timeout', 0)))
+            body = self.server.status
+        elif query.get('id') == 'action':
+            self.server.actions.append((time.time(), query))
+            body = 'OK'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
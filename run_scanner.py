@@ -4,16 +4,51 @@ SCANNER_NAME = 'Basement'
 VERA_IP = '192.168.7.205'
 
 FOUND_HOLD_TIME = 120  # Timeout to go to not found (s)
-BEACON_LISTEN_PERIOD = 10  # How often we listen for beacons (s)
-BEACON_LISTEN_TIMEOUT = 2  # Timeout on receiving beacon reports (s)
-BEACON_LISTEN_QTY = 10 # How many beacon reports per listen
+BEACON_RETRY_PERIOD = 10  # How long before reopening a failed adapter (s)
+BEACON_FILTER_DUPLICATES = False  # Have the adapter drop repeated adverts
+BEACON_DUPLICATE_RESET = 5  # How often repeats are let through again (s)
+BEACON_SCAN_INTERVAL = 10  # How often the adapter starts a scan window (ms)
+BEACON_SCAN_WINDOW = 10  # How long each scan window lasts (ms)
+BEACON_SCAN_ACTIVE = False  # Ask beacons for scan responses as well
+BEACON_RANDOM_ADDRESS = False  # Scan with the adapter's random address
+BEACON_DUTY_CYCLE = False  # Shorten the scan window while beacons are steady
+BEACON_MIN_WINDOW = 2.5  # Shortest scan window in duty cycle mode (ms)
+BEACON_DUTY_PERIOD = 30  # How often the scan window is adjusted (s)
+BEACON_READER_PROCESS = False  # Read each adapter in a separate process
+BEACON_RING_SIZE = 4096  # Adverts buffered for the main process (power of 2)
 POLLPERIOD_LIVE = 60  # Pollperiod for live bluetooth devices (s)
 POLLPERIOD_DEAD = 10  # Pollperiod for dead bluetooth devices (s)
+POLLPERIOD_DEAD_MAX = 300  # Longest pollperiod for long dead devices (s)
+PHONE_PAGE_BUDGET = 0.25  # Max fraction of time polling phones (None = any)
+PHONE_BEACONS = {}  # Phone address -> address of a beacon with the same owner
+PHONE_WORKERS = 1  # Devices polled at once (pages queue on the one radio)
+LE_ADAPTERS = None  # hci numbers to scan beacons on, e.g. [0] (None = auto)
+PHONE_ADAPTER = None  # hci number to poll phones on, e.g. 1 (None = auto)
 MIN_REPORT_IDLE_TIME = 30  # Min time between Vera updates for each device (s)
-VERA_SYNC_PERIOD = 600  # How often we sync device list to Vera (s)
-VERA_SYNC_RETRY = 10 # How often we retry sync if it fails or no devices (s)
+RSSI_SMOOTHING = 0.3  # Weight of each new RSSI reading (1 = no smoothing)
+RSSI_REPORT_DELTA = 6  # Smoothed RSSI change that is sent to Vera (dB)
+REPORT_KEEPALIVE = 60  # Max time between Vera updates while present (s)
+VERA_SYNC_PERIOD = 3600  # How often the whole device list is fetched (s)
+VERA_SYNC_RETRY = 10 # How soon we retry if Vera can't be reached (s)
+VERA_POLL_TIMEOUT = 60  # Longest wait for Vera to report device changes (s)
+VERA_POLL_DELAY = 1  # How long Vera waits to batch device changes (s)
+VERA_TIMEOUT = 5  # Timeout on each request to Vera (s)
+VERA_MAX_BACKOFF = 60  # Longest wait between retries when Vera is down (s)
+VERA_QUEUE_SIZE = 256  # Max devices with updates waiting to go to Vera
+STATE_FILE = 'scanner_state.db'  # Saved state, beside this file (None = off)
+STATE_SAVE_PERIOD = 60  # How often changed state is saved (s)
+METRICS_PORT = None  # Local port serving Prometheus metrics, e.g. 9105
+METRICS_LOG_PERIOD = None  # How often to log a metrics summary (s)
+
+# Multi scanner setup: scanners send sightings to one aggregator, which
+# decides which room each device is in and is the only one reporting to Vera
+AGGREGATOR = None  # (host, port) of the aggregator to send sightings to
+AGGREGATOR_PORT = None  # Port to listen on to run as the aggregator
+AGGREGATOR_INTERVAL = 2  # Min time between sightings sent per device (s)
+AGGREGATOR_WINDOW = 10  # How long a beacon sighting counts (s), phones'
+                        # count for POLLPERIOD_LIVE longer
+AGGREGATOR_MARGIN = 5  # How much louder a new room must be to move (dB)
 
-VERA_MSG_BASE = 'http://%s:3480' % (VERA_IP)
 SVC_ID = 'urn:afoyi-com:serviceId:PresenceSensor1'
 DEV_TYPE = 'urn:schemas-afoyi-com:device:PresenceSensor:1'
 
@@ -22,325 +57,591 @@ import datetime
 import time
 import logging
 import logging.handlers
+import os
+import signal
 import sys
-import math
-import struct
-import array
-import fcntl
-import urllib
-import urllib2
-import json
 import bluetooth._bluetooth as bluez
 import blescan
+import aggregator
+import devices
+import metrics
+import phones
+import scheduler
+import store
+import vera
 
 
-def msg_vera(msg):
-    """Send a command to Vera.
-
-    Arguments:
-    msg --- the partial url of the message starting after <address:port>/
+def get_device_settings(device):
+    """Get the presence settings of a device from Vera's json.
 
     Returns:
-    reply from Vera json formatted if json, otherwise as string
+    (address, device_type), either of which is None if not set
     """
-    url = '%s/%s' % (VERA_MSG_BASE, msg)
-    for i in range(1,3):
-        try:
-            conn = urllib2.urlopen(url)
-            data = conn.read()
-            success = True
-        except:
-            success = False
-        if success:
-            conn.close
-            break
-    if not success:
-        logger.debug('Failed to communicate to Vera')
-        data = None
-    else:
-        try:
-            data = json.loads(data)
-        except:
-            pass
-    return data
+    address = None
+    device_type = None
+    for state in device['states']:
+        if state['service'] == SVC_ID and state['variable'] == 'Address':
+            address = state['value'].upper()
+            if device_type is not None:
+                break
+            continue
+        if (state['service'] == SVC_ID
+                and state['variable'] == 'DeviceType'):
+            device_type = state['value']
+            if address is not None:
+                break
+    return address, device_type
 
 
-def find_device(id, address, type, device_list):
-    """Look for a device in Vera's list matching specified criteria.
+def find_device(id, address, type, device_index):
+    """Look for a device in Vera's devices matching specified criteria.
 
     Arguments:
     id --- the Vera deviceid as a string
     address --- the bluetooth address
     type --- the bluetooth type ('ibeacon' or 'bluetooth')
-    device_list --- the list of devices from Vera's json reply
+    device_index --- dict of Vera deviceid to (address, type)
 
     Returns:
     true if found
     """
-    match = 0
-    for dev in device_list:
-        if dev['id'] != id:
-            continue
-        for state in dev['states']:
-            if state['service'] == SVC_ID:
-                if state['variable'] == 'Address':
-                    if state['value'].upper() == address:
-                        match += 1
-                    else:
-                        break
-            if state['service'] == SVC_ID:
-                if state['variable'] == 'DeviceType':
-                    if state['value'] == type:
-                        match += 1
-                    else:
-                        break
-            if match == 2:
-                break
-        break
-    return match == 2
+    return device_index.get(id) == (address, type)
 
 
-def configure_known_devices(known_beacons, known_phones):
-    """Get all Presence Sensors from Vera and put in local structures.
+def index_devices(device_list, device_index=None):
+    """Index Vera's devices by id.
 
     Arguments:
-    known_beacons --- a dictionary of currently known beacons
-    known_phones --- a dictionary of currently known phones
+    device_list --- Vera's json for the devices, which may only have the
+                    variables that have changed
+    device_index --- an index to update, instead of making a new one
 
     Returns:
-    known_beacons, known_phones --- above dicts synced to Vera
-
-    Notes:
-    1) If a sensor is deleted from Vera, it will be deleted from the dict
-    2) If a sensor was in the dict and still is, it's data is not
-       reinitialized
+    dict of Vera deviceid to (address, type), either of which is None if
+    not set
     """
-    vera_objects = msg_vera('data_request?id=user_data')
-    if vera_objects is None:
-        return known_beacons, known_phones
-    device_list = filter(lambda item: item['device_type'] == DEV_TYPE,
-                         vera_objects['devices'])
-    # LUA is loosy goosy with str vs int, so make all id's string
+    if device_index is None:
+        device_index = {}
     for device in device_list:
-        device['id'] = str(device['id'])
-    logger.debug('Checking Vera device list')
+        # LUA is loosy goosy with str vs int, so make all id's string
+        device_id = str(device['id'])
+        address, device_type = get_device_settings(device)
+        old_address, old_type = device_index.get(device_id, (None, None))
+        if address is None:
+            address = old_address
+        if device_type is None:
+            device_type = old_type
+        device_index[device_id] = (address, device_type)
+    return device_index
+
 
+def update_registry(registry, device_index):
+    """Add and remove devices so the registry matches Vera's devices.
+
+    Arguments:
+    registry --- the devices.DeviceRegistry of currently known devices
+    device_index --- dict of Vera deviceid to (address, type), see
+                     index_devices()
+    """
     # Check if previously known devices have been removed from Vera
-    for address, beacon in known_beacons.items():
-        if  not find_device(beacon['id'], address, 'ibeacon', device_list):
-            del known_beacons[address]
-            logger.debug('Deleting ibeacon %s from device list' % address)
-    for address, phone in known_phones.items():
-        if  not find_device(phone['id'], address, 'bluetooth', device_list):
-            del known_phones[address]
-            logger.debug('Deleting bluetooth %s from device list' % address)
+    for device in list(registry):
+        if not find_device(device.id, device.address, device.kind,
+                           device_index):
+            registry.remove(device)
+            logger.debug('Deleting %s %s from device list'
+                         % (device.kind, device.address))
 
     # Add new devices
-    for device in device_list:
-        address = None
-        device_type = None
-        for state in device['states']:
-            if state['service'] == SVC_ID and state['variable'] == 'Address':
-                address = state['value'].upper()
-                if device_type is not None:
-                    break
-                continue
-            if (state['service'] == SVC_ID
-                    and state['variable'] == 'DeviceType'):
-                device_type = state['value']
-                if address is not None:
-                    break
+    for device_id, (address, device_type) in device_index.iteritems():
         if address is None or device_type is None:
             logger.debug('Device id = %s is incomplete. Skipping.'
-                         % device['id'])
+                         % device_id)
+            continue
+        if device_type not in (devices.BEACON, devices.PHONE):
+            logger.debug('Device %s id = %s has invalid type (%s). Skipping.'
+                         % (address, device_id, device_type))
             continue
-        if device_type == 'bluetooth':
-            if address in known_phones:
-                logger.debug('Bluetooth %s already in device list'
-                             % address)
+        if registry.find(device_type, address) is not None:
+            logger.debug('%s %s already in device list'
+                         % (device_type, address))
+            continue
+        if registry.add(device_id, address, device_type) is None:
+            logger.debug('Device %s id = %s has invalid address. Skipping.'
+                         % (address, device_id))
+            continue
+        logger.debug('Adding %s %s to device list id = %s'
+                     % (device_type, address, device_id))
+
+
+matched_adverts = metrics.counter('ble_adverts_matched_total',
+                                  'Adverts from known beacons')
+
+
+def assign_adapters():
+    """Decide which local adapters scan beacons and which polls phones.
+
+    LE_ADAPTERS and PHONE_ADAPTER are used when set.  Otherwise, with more
+    than one adapter the last one polls phones and the others scan beacons,
+    so beacon scans carry on while phones are being paged.  A single adapter
+    does both.
+
+    Returns:
+    list of LE adapter numbers, phone adapter number
+    """
+    adapters = blescan.list_adapters() or [0]
+    le_adapters = LE_ADAPTERS
+    phone_adapter = PHONE_ADAPTER
+    if phone_adapter is None:
+        if le_adapters is not None:
+            spare = [i for i in adapters if i not in le_adapters]
+            phone_adapter = (spare or le_adapters)[-1]
+        else:
+            phone_adapter = adapters[-1]
+    if le_adapters is None:
+        le_adapters = ([i for i in adapters if i != phone_adapter]
+                       or [phone_adapter])
+    return le_adapters, phone_adapter
+
+
+class Scanner(object):
+    """The presence scanner: Vera sync, beacon scanning and phone polling.
+
+    Everything is driven by an scheduler.EventLoop: timers for reopening
+    adapters and each beacon's hold time, and readers for the beacon scan
+    socket of each LE adapter, phone poll results and Vera device changes.
+    """
+
+    def __init__(self, open_dev=bluez.hci_open_dev):
+        """
+        Arguments:
+        open_dev --- function opening an HCI socket for the beacon scan
+        """
+        self.registry = devices.DeviceRegistry()
+        self.sync_state = {}
+        self.sensors = {}
+        # Addresses from Vera are upper case, so match the config to them
+        self.phone_beacons = dict(
+            (phone.upper(), beacon.upper())
+            for phone, beacon in PHONE_BEACONS.iteritems())
+        self.loop = scheduler.EventLoop()
+        le_adapters, phone_adapter = assign_adapters()
+        logger.debug('Scanning beacons on hci%s, polling phones on hci%d'
+                     % (',hci'.join(str(i) for i in le_adapters),
+                        phone_adapter))
+        self.scanners = [
+            blescan.LEScanner(dev_id,
+                              filter_duplicates=BEACON_FILTER_DUPLICATES,
+                              duplicate_reset=BEACON_DUPLICATE_RESET,
+                              open_dev=open_dev,
+                              reader_process=BEACON_READER_PROCESS,
+                              ring_size=BEACON_RING_SIZE,
+                              active=BEACON_SCAN_ACTIVE,
+                              interval=BEACON_SCAN_INTERVAL,
+                              window=BEACON_SCAN_WINDOW,
+                              own_type=(blescan.LE_RANDOM_ADDRESS
+                                        if BEACON_RANDOM_ADDRESS
+                                        else blescan.LE_PUBLIC_ADDRESS))
+            for dev_id in le_adapters]
+        self.scanner_timers = dict.fromkeys(self.scanners)
+        self.present_beacons = frozenset()
+        self.connections = phones.PhoneConnections(phone_adapter)
+        self.poller = phones.PhonePoller(self.connections.get_RSSI,
+                                         workers=PHONE_WORKERS,
+                                         skip=self.owner_present,
+                                         budget=PHONE_PAGE_BUDGET)
+        self.store = None
+        if STATE_FILE is not None:
+            self.store = store.StateStore(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), STATE_FILE))
+        self.sightings = None
+        if AGGREGATOR is not None:
+            self.sightings = aggregator.SightingSender(
+                AGGREGATOR[0], AGGREGATOR[1], SCANNER_NAME)
+
+    def run(self):
+        reporter.start()
+        self.poller.start()
+        self.loop.add_reader(self.poller, self.read_phones)
+        if self.store is not None:
+            self.restore()
+            self.loop.call_later(STATE_SAVE_PERIOD, self.save_state)
+        subscriber.start()
+        self.loop.add_reader(subscriber, self.read_vera)
+        if BEACON_DUTY_CYCLE:
+            self.loop.call_later(BEACON_DUTY_PERIOD, self.adjust_scan_window)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.loop.stop())
+        try:
+            self.loop.run()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop scanning, drop the phone links and save the state."""
+        for scanner in self.scanners:
+            if scanner.sock is not None:
+                self.close_scanner(scanner)
+        self.connections.close()
+        if self.store is not None:
+            self.store.flush(self.registry, self.sync_state, self.sensors)
+        logger.debug('Scanner stopped')
+
+    def restore(self):
+        """Start looking for the devices saved by the last run.
+
+        Phones are polled when they were due, spread out over
+        POLLPERIOD_DEAD, instead of all at once.
+        """
+        try:
+            count = self.store.load(self.registry, self.sync_state,
+                                    self.sensors)
+        except store.sqlite3.Error, e:
+            logger.debug('Failed to load saved state: %s' % e)
+            return
+        if not count:
+            return
+        logger.debug('Loaded %d devices from saved state' % count)
+        if self.sensors:
+            subscriber.resume(self.sync_state.get('DataVersion'),
+                              self.sync_state.get('LoadTime'))
+        now = time.time()
+        spread = POLLPERIOD_DEAD / float(max(len(self.registry.phones), 1))
+        for i, phone in enumerate(self.registry.phones.itervalues()):
+            self.poller.schedule(phone.address,
+                                 max(phone.next_poll, now + i * spread))
+        self.start_devices()
+
+    def save_state(self):
+        self.store.flush(self.registry, self.sync_state, self.sensors)
+        self.loop.call_later(STATE_SAVE_PERIOD, self.save_state)
+
+    def state_changed(self, device):
+        """Note a device's presence changed, for the saved state."""
+        if self.store is not None:
+            self.store.changed(device)
+
+    def read_vera(self):
+        """Apply the device list and changes fetched from Vera."""
+        for full, data_version, load_time, device_list in (
+                subscriber.get_updates()):
+            if full:
+                logger.debug('Checking Vera device list')
+                self.sensors = index_devices(device_list)
+            else:
+                logger.debug('Checking changed Vera devices')
+                index_devices(device_list, self.sensors)
+            self.sync_state['DataVersion'] = data_version
+            self.sync_state['LoadTime'] = load_time
+        update_registry(self.registry, self.sensors)
+        self.start_devices()
+        if not self.registry:
+            logger.debug('No devices to search for')
+        if self.store is not None:
+            self.store.changed_all()
+            self.store.flush(self.registry, self.sync_state, self.sensors)
+
+    def start_devices(self):
+        """Bring polling, hold timers and scanning in line with the registry."""
+        self.poller.sync(set(self.registry.phones))
+        self.connections.prune(self.registry.phones)
+        for beacon in self.registry.expire(devices.BEACON,
+                                           time.time() - FOUND_HOLD_TIME):
+            logger.debug('iBeacon %s is now not present' % beacon.address)
+            self.state_changed(beacon)
+        for beacon in self.registry.beacons.itervalues():
+            if beacon.last_state and beacon.expiry is None:
+                beacon.expiry = self.loop.call_at(
+                    beacon.last_seen + FOUND_HOLD_TIME,
+                    self.expire_beacon, beacon)
+        for scanner in self.scanners:
+            self.update_scanner(scanner)
+
+    def update_scanner(self, scanner):
+        """Start or stop a beacon scan as the device list requires."""
+        if self.registry.beacons and scanner.sock is None:
+            if self.scanner_timers[scanner] is None:
+                self.open_scanner(scanner)
+        elif not self.registry.beacons and scanner.sock is not None:
+            self.close_scanner(scanner)
+            logger.debug('Beacon scanning stopped on hci%d' % scanner.dev_id)
+
+    def open_scanner(self, scanner):
+        self.scanner_timers[scanner] = None
+        if not self.registry.beacons or scanner.sock is not None:
+            return
+        try:
+            scanner.open()
+        except:
+            logger.debug("Error accessing bluetooth device hci%d for beacon "
+                         "scan" % scanner.dev_id)
+            self.scanner_timers[scanner] = self.loop.call_later(
+                BEACON_RETRY_PERIOD, self.open_scanner, scanner)
+            return
+        logger.debug('Beacon scanning started on hci%d' % scanner.dev_id)
+        self.loop.add_reader(scanner, self.read_scanner, scanner)
+        if scanner.next_duplicate_reset is not None:
+            self.scanner_timers[scanner] = self.loop.call_at(
+                scanner.next_duplicate_reset, self.reset_duplicates, scanner)
+
+    def close_scanner(self, scanner):
+        self.loop.remove_reader(scanner)
+        if self.scanner_timers[scanner] is not None:
+            self.loop.cancel(self.scanner_timers[scanner])
+            self.scanner_timers[scanner] = None
+        scanner.close()
+
+    def restart_scanner(self, scanner):
+        """Close a beacon scan after an error and retry it later."""
+        self.close_scanner(scanner)
+        self.scanner_timers[scanner] = self.loop.call_later(
+            BEACON_RETRY_PERIOD, self.open_scanner, scanner)
+
+    def reset_duplicates(self, scanner):
+        """Let an adapter report beacons it has already reported again."""
+        try:
+            scanner.reset_duplicates()
+        except:
+            logger.debug('Error restarting beacon scan on hci%d'
+                         % scanner.dev_id)
+            self.restart_scanner(scanner)
+            return
+        self.scanner_timers[scanner] = self.loop.call_at(
+            scanner.next_duplicate_reset, self.reset_duplicates, scanner)
+
+    def adjust_scan_window(self):
+        """Trade beacon scanning time against how quickly beacons are heard.
+
+        While every known beacon stays present and is heard within
+        BEACON_DUTY_PERIOD, the scan window is halved, down to
+        BEACON_MIN_WINDOW.  As soon as a beacon arrives, leaves or goes
+        unheard for that long, and for as long as any is missing, the window
+        goes back to BEACON_SCAN_WINDOW.
+        """
+        self.loop.call_later(BEACON_DUTY_PERIOD, self.adjust_scan_window)
+        cutoff = time.time() - BEACON_DUTY_PERIOD
+        present = [beacon for beacon in self.registry.beacons.itervalues()
+                   if beacon.last_state]
+        ids = frozenset(beacon.id for beacon in present)
+        steady = (present
+                  and len(present) == len(self.registry.beacons)
+                  and ids == self.present_beacons
+                  and all(beacon.last_seen >= cutoff for beacon in present))
+        self.present_beacons = ids
+        for scanner in self.scanners:
+            if scanner.sock is None:
+                continue
+            if steady:
+                window = max(scanner.window / 2.0, BEACON_MIN_WINDOW)
+            else:
+                window = BEACON_SCAN_WINDOW
+            if window == scanner.window:
                 continue
-            known_phones[address] = {
-                'id': device['id'],
-                'last_state': False,
-                'last_seen': 0,
-                'next_poll': 0
-                }
-            logger.debug('Adding %s %s to device list id = %s'
-                         % (device_type, address, device['id']))
-        elif device_type == 'ibeacon':
-            if address in known_beacons:
-                logger.debug('iBeacon %s already in device list'
-                             % address)
+            try:
+                scanner.set_window(window)
+            except:
+                logger.debug('Error changing beacon scan on hci%d'
+                             % scanner.dev_id)
+                self.restart_scanner(scanner)
                 continue
-            known_beacons[address] = {
-                'id': device['id'],
-                'last_state': False,
-                'last_seen': 0,
-                'last_report': 0
-                }
-            logger.debug('Adding %s %s to device list id = %s'
-                         % (device_type, address, device['id']))
+            logger.debug('Beacon scan window on hci%d is now %gms'
+                         % (scanner.dev_id, window))
+
+    def read_scanner(self, scanner):
+        try:
+            adverts = scanner.read()
+        except (IOError, bluez.error):
+            logger.debug('Error reading beacon scan on hci%d, restarting '
+                         'adapter' % scanner.dev_id)
+            self.restart_scanner(scanner)
+            return
+        for advert in adverts:
+            self.process_advert(advert)
+
+    def process_advert(self, advert):
+        """Update a known beacon from a received blescan.Advert."""
+        beacon = self.registry.match(advert)
+        if beacon is None:
+            return
+        matched_adverts.inc()
+        now = time.time()
+        if not beacon.last_state:
+            beacon.last_state = True
+            self.state_changed(beacon)
+            logger.debug('iBeacon %s now present' % beacon.address)
+        beacon.update_rssi(advert.rssi, RSSI_SMOOTHING)
+        self.report(beacon, now)
+        beacon.last_seen = now
+        if beacon.expiry is None:
+            beacon.expiry = self.loop.call_at(now + FOUND_HOLD_TIME,
+                                              self.expire_beacon, beacon)
+
+    def report(self, device, now):
+        """Send a present device's RSSI to Vera if it needs reporting.
+
+        With an aggregator, the RSSI is sent to it instead every
+        AGGREGATOR_INTERVAL.
+        """
+        if self.sightings is not None:
+            if now - device.last_report >= AGGREGATOR_INTERVAL:
+                valid = AGGREGATOR_WINDOW
+                if device.kind == devices.PHONE:
+                    valid += POLLPERIOD_LIVE
+                self.sightings.send(device.id, device.rssi, now, valid)
+                device.reported(now)
+            return
+        if not device.needs_report(now, MIN_REPORT_IDLE_TIME,
+                                   RSSI_REPORT_DELTA, REPORT_KEEPALIVE):
+            return
+        value = (SCANNER_NAME + ',' + str(FOUND_HOLD_TIME)
+                 + ',' + str(int(round(device.rssi))))
+        reporter.set_present(device.id, value)
+        device.reported(now)
+
+    def expire_beacon(self, beacon):
+        """Mark a beacon not seen for FOUND_HOLD_TIME as not present.
+
+        The timer is only set when a beacon becomes present, so if it has
+        been seen since, the timer is just moved on to its new expiry.
+        """
+        beacon.expiry = None
+        if not beacon.last_state:
+            return
+        expiry = beacon.last_seen + FOUND_HOLD_TIME
+        if expiry > time.time():
+            beacon.expiry = self.loop.call_at(expiry, self.expire_beacon,
+                                              beacon)
+            return
+        beacon.absent()
+        self.state_changed(beacon)
+        logger.debug('iBeacon %s is now not present' % beacon.address)
+
+    def read_phones(self):
+        for address, RSSI, when in self.poller.get_results():
+            next_poll = self.process_phone(address, RSSI, when)
+            if next_poll is not None:
+                self.poller.schedule(address, next_poll)
+
+    def owner_present(self, address):
+        """Decide whether polling a phone can be skipped.
+
+        Called from the poller's threads.  A present phone need not be paged
+        while the beacon of the same owner (see PHONE_BEACONS) has been
+        heard within POLLPERIOD_LIVE.  A phone with no RSSI yet (e.g. one
+        restored from the saved state) is always paged, as there is nothing
+        to report for it otherwise.
+
+        Returns:
+        true if the poll isn't needed
+        """
+        phone = self.registry.phones.get(address)
+        beacon_address = self.phone_beacons.get(address)
+        if (phone is None or beacon_address is None or not phone.last_state
+                or phone.rssi is None):
+            return False
+        beacon = self.registry.find(devices.BEACON, beacon_address)
+        return (beacon is not None and beacon.last_state
+                and beacon.last_seen > time.time() - POLLPERIOD_LIVE)
+
+    def process_phone(self, address, RSSI, when):
+        """Update a known phone from the result of polling it.
+
+        A phone that answers is polled again after POLLPERIOD_LIVE.  One that
+        doesn't is polled every POLLPERIOD_DEAD until its hold time runs out,
+        so it is found again or marked absent promptly, then less and less
+        often while it stays away, up to POLLPERIOD_DEAD_MAX.
+
+        Arguments:
+        address --- the phone's bluetooth address
+        RSSI --- the RSSI read from the phone, None if it didn't answer, or
+                 phones.SKIPPED if its owner's beacon was heard instead
+        when --- the time the poll finished
+
+        Returns:
+        the time the phone should next be polled, None if it is no longer
+        known
+        """
+        phone = self.registry.phones.get(address)
+        if phone is None:
+            return None
+        if RSSI is phones.SKIPPED:
+            if phone.last_state and phone.rssi is not None:
+                phone.last_seen = when
+                self.report(phone, when)
+            phone.next_poll = when + POLLPERIOD_LIVE
+        elif RSSI is not None:
+            if not phone.last_state:
+                phone.last_state = True
+                self.state_changed(phone)
+                logger.debug('Bluetooth %s now present' % address)
+            phone.update_rssi(RSSI, RSSI_SMOOTHING)
+            self.report(phone, when)
+            phone.last_seen = when
+            phone.misses = 0
+            phone.next_poll = when + POLLPERIOD_LIVE
+        elif phone.last_state:
+            if phone.last_seen + FOUND_HOLD_TIME < when:
+                phone.absent()
+                self.state_changed(phone)
+                logger.debug('Bluetooth %s is now not present' % address)
+            phone.next_poll = when + POLLPERIOD_DEAD
         else:
-            logger.debug('Device id = %s has invalid type (%s). Skipping.'
-                         % (address, device['id'], device_type))
-    return known_beacons, known_phones
-
-
-def get_RSSI(addr):
-    # Open an hci socket
-    hci_sock = bluez.hci_open_dev()
-    hci_fd = hci_sock.fileno ()
-
-    # Try to open a connection to remote BT device
-    try:
-        bt_sock = bluez.SDPSession ()
-        bt_sock.connect(addr)
-    except:
-        bt_sock.close()
-        hci_sock.close()
-        return None
-    # Get handle to ACL connection to remote BT device
-    reqstr = struct.pack ("6sB17s", bluez.str2ba (addr),
-            bluez.ACL_LINK, "\0" * 17)
-    request = array.array ("c", reqstr)
-    fcntl.ioctl (hci_fd, bluez.HCIGETCONNINFO, request, 1)
-    handle = struct.unpack ("8xH14x", request.tostring ())[0]
-
-    # Get RSSI
-    cmd_pkt=struct.pack('H', handle)
-    RSSI = bluez.hci_send_req(hci_sock, bluez.OGF_STATUS_PARAM,
-                           bluez.OCF_READ_RSSI,
-                           bluez.EVT_CMD_COMPLETE, 4, cmd_pkt)
-    RSSI = struct.unpack('b', RSSI[3])[0]
-
-    bt_sock.close()
-    hci_sock.close()
-    return RSSI
+            phone.misses += 1
+            phone.next_poll = when + min(
+                POLLPERIOD_DEAD * 2 ** min(phone.misses - 1, 16),
+                POLLPERIOD_DEAD_MAX)
+        return phone.next_poll
+
+
+def run_aggregator():
+    """Loop forever placing devices from other scanners' sightings."""
+
+    def report(device_id, scanner, rssi):
+        reporter.set_present(device_id, '%s,%d,%d'
+                             % (scanner, FOUND_HOLD_TIME, rssi))
+
+    node = aggregator.Aggregator(AGGREGATOR_PORT, AGGREGATOR_MARGIN,
+                                 REPORT_KEEPALIVE, report)
+    loop = scheduler.EventLoop()
+
+    def sweep():
+        node.sweep()
+        loop.call_later(AGGREGATOR_WINDOW, sweep)
+
+    reporter.start()
+    loop.add_reader(node, node.read)
+    loop.call_later(AGGREGATOR_WINDOW, sweep)
+    logger.debug('Aggregating sightings on port %d' % AGGREGATOR_PORT)
+    loop.run()
 
 
 def main():
     """Loop forever getting Vera devices, scanning beacons and phones."""
-    known_beacons = {}
-    known_phones = {}
-    next_Vera_sync = time.time()
-    next_beacon_scan = time.time()
-    while True:
-
-        # Get Vera devices if it is time
-        if time.time() >= next_Vera_sync:
-            while True:
-                known_beacons, known_phones = (
-                    configure_known_devices(known_beacons, known_phones))
-                if known_beacons or known_phones:
-                    break
-                logger.debug('No devices to search for, sleeping for %d secs'
-                             % VERA_SYNC_RETRY)
-                time.sleep(VERA_SYNC_RETRY)
-            next_Vera_sync = time.time() + VERA_SYNC_PERIOD
-
-        # Scan for iBeacons if it is time
-        if known_beacons and (time.time() >= next_beacon_scan):
-            try:
-                sock = bluez.hci_open_dev()
-                blescan.hci_le_set_scan_parameters(sock)
-                blescan.hci_enable_le_scan(sock)
-            except:
-                logger.debug(
-                    "Error accessing bluetooth device for beacon scan")
-                return 1
-            sock.settimeout(BEACON_LISTEN_TIMEOUT)
-            try:
-                returnedList = blescan.parse_events(sock, BEACON_LISTEN_QTY)
-            except:
-                returnedList = []
-            sock.close()
-
-            # Check for beacons reporting
-            found_beacons = {}
-            for advert in returnedList:
-                advert = advert.split(',')
-                MAC = advert[0].upper()
-                UUID = advert[1] + ',' + advert[2] + ',' + advert[3]
-                UUID = UUID.upper()
-                if MAC in found_beacons or UUID in found_beacons:
-                    continue
-                if MAC in known_beacons:
-                    address = MAC
-                elif UUID in known_beacons:
-                    address = UUID
-                else:
-                    continue
-                found_beacons[address] = True
-                if not known_beacons[address]['last_state']:
-                    known_beacons[address]['last_state'] = True
-                    logger.debug('iBeacon %s now present' % address)
-                if (known_beacons[address]['last_report']
-                        + MIN_REPORT_IDLE_TIME) < time.time():
-                    value = (SCANNER_NAME + ',' + str(FOUND_HOLD_TIME)
-                             + ',' + advert[5])
-                    msg_vera('data_request?id=action'
-                             + '&DeviceNum=' + known_beacons[address]['id']
-                             + '&serviceId=' + SVC_ID
-                             + '&action=SetPresent&newPresentValue=' + value)
-                    known_beacons[address]['last_report'] = time.time()
-                known_beacons[address]['last_seen'] = time.time()
-            # Check for beacons that have disappeared
-            for address, beacon in known_beacons.items():
-                if address in found_beacons:
-                    continue
-                if (beacon['last_state']
-                        and beacon['last_seen'] + FOUND_HOLD_TIME
-                        < time.time()):
-                    known_beacons[address]['last_state'] = False
-                    logger.debug('iBeacon %s is now not present'
-                                 % address)
-            next_beacon_scan = time.time() + BEACON_LISTEN_PERIOD
-
-        # Scan for phones if it is time
-        for address, phone in known_phones.items():
-            if phone['next_poll'] > time.time():
-                continue
-            RSSI = get_RSSI(address)
-            found = RSSI != None
-            if found:
-                if not phone['last_state']:
-                    known_phones[address]['last_state'] = True
-                    logger.debug('Bluetooth %s now present' % address)
-                value = (SCANNER_NAME + ',' + str(FOUND_HOLD_TIME)
-                         + ',' + str(RSSI))
-                msg_vera('data_request?id=action'
-                         + '&DeviceNum=' + known_phones[address]['id']
-                         + '&serviceId=' + SVC_ID
-                         + '&action=SetPresent&newPresentValue='
-                         + value)
-                known_phones[address]['last_seen'] = time.time()
-                known_phones[address]['next_poll'] = (time.time()
-                                                      + POLLPERIOD_LIVE)
-            else:
-                if (phone['last_state']
-                        and phone['last_seen'] + FOUND_HOLD_TIME
-                        < time.time()):
-                    known_phones[address]['last_state'] = False
-                    logger.debug('Bluetooth %s is now not present'
-                                 % address)
-                known_phones[address]['next_poll'] = (time.time()
-                                                      + POLLPERIOD_DEAD)
-        # Sleep 'til next event ready
-        next_event = next_Vera_sync
-        if (next_beacon_scan < next_event) and known_beacons:
-            next_event = next_beacon_scan
-        for _, phone in known_phones.items():
-            if phone['next_poll'] < next_event:
-                next_event = phone['next_poll']
-        sleep_time = next_event - time.time()
-        if sleep_time > 0:
-            time.sleep(math.ceil(sleep_time))
+    if METRICS_PORT is not None:
+        metrics.serve('127.0.0.1', METRICS_PORT)
+    if METRICS_LOG_PERIOD is not None:
+        metrics.log_summaries(logger, METRICS_LOG_PERIOD)
+    if AGGREGATOR_PORT is not None:
+        run_aggregator()
+    else:
+        Scanner().run()
+
 
 # create the logger for this module
 logger = logging.getLogger('Bluetooth Scanner')
 logger.setLevel(logging.DEBUG)
-logger.addHandler(logging.handlers.SysLogHandler(address='/dev/log'))
+
+# Vera connections: one for the reporting thread
+reporter = vera.VeraReporter(vera.VeraConnection(VERA_IP, timeout=VERA_TIMEOUT),
+                             SVC_ID, max_pending=VERA_QUEUE_SIZE,
+                             max_backoff=VERA_MAX_BACKOFF)
+# and one following device changes, waiting up to VERA_POLL_TIMEOUT for them
+subscriber = vera.VeraSubscriber(
+    vera.VeraConnection(VERA_IP, timeout=VERA_TIMEOUT + VERA_POLL_TIMEOUT),
+    DEV_TYPE, SVC_ID, ('Address', 'DeviceType'),
+    poll_timeout=VERA_POLL_TIMEOUT, minimum_delay=VERA_POLL_DELAY,
+    sync_period=VERA_SYNC_PERIOD, min_backoff=VERA_SYNC_RETRY,
+    max_backoff=VERA_MAX_BACKOFF)
 
 if __name__ == '__main__':
+    logger.addHandler(logging.handlers.SysLogHandler(address='/dev/log'))
     ret_val = main()
     sys.exit(ret_val)
@@ -0,0 +1,96 @@
+"""A small select() based event loop with heap ordered timers."""
+
+import errno
+import heapq
+import itertools
+import select
+import time
+import metrics
+
+loop_lag = metrics.histogram('loop_lag_seconds',
+                             'How late timers run after their deadline')
+
+
+class Timer(object):
+    """A pending call made by EventLoop.  Cancel with EventLoop.cancel()."""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class EventLoop(object):
+    """Run timers at their deadlines and callbacks for readable files.
+
+    The loop blocks in select() until the earliest timer is due or one of
+    the registered files becomes readable, so nothing is polled and timers
+    fire as close to their deadline as the OS allows.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+        self.readers = {}
+        self.running = False
+
+    def call_at(self, when, callback, *args):
+        """Call callback(*args) at time when.  Returns a Timer."""
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.timers, (when, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) in delay seconds.  Returns a Timer."""
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        timer.cancelled = True
+
+    def add_reader(self, fileobj, callback, *args):
+        """Call callback(*args) whenever fileobj is readable."""
+        self.readers[fileobj] = (callback, args)
+
+    def remove_reader(self, fileobj):
+        self.readers.pop(fileobj, None)
+
+    def stop(self):
+        self.running = False
+
+    def run_timers(self):
+        """Run every timer that is due.  Returns the time until the next."""
+        while self.timers:
+            when, _, timer = self.timers[0]
+            if timer.cancelled:
+                heapq.heappop(self.timers)
+                continue
+            now = time.time()
+            if when > now:
+                return when - now
+            heapq.heappop(self.timers)
+            loop_lag.observe(now - when)
+            timer.callback(*timer.args)
+        return None
+
+    def run(self):
+        """Run until stop() is called."""
+        self.running = True
+        while self.running:
+            timeout = self.run_timers()
+            if not self.running:
+                break
+            try:
+                readable, _, _ = select.select(list(self.readers), [], [],
+                                               timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fileobj in readable:
+                # A callback may have removed a later reader
+                if fileobj in self.readers:
+                    callback, args = self.readers[fileobj]
+                    callback(*args)
@@ -0,0 +1,112 @@
+"""Keeping the scanner's device state on disk for warm restarts."""
+
+import logging
+import sqlite3
+
+logger = logging.getLogger('Bluetooth Scanner')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    id TEXT PRIMARY KEY,
+    address TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    last_state INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    next_poll REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sensors (
+    id TEXT PRIMARY KEY,
+    address TEXT,
+    kind TEXT
+);
+CREATE TABLE IF NOT EXISTS sync (
+    key TEXT PRIMARY KEY,
+    value
+);
+'''
+
+
+class StateStore(object):
+    """The device registry and Vera sync state in an sqlite file.
+
+    The sync state includes Vera's presence sensors, complete or not, so
+    that later changes to them can be applied after a restart.  Only what
+    has changed is written: devices marked with changed(), the last seen
+    times of present devices, and the whole device list and sync state
+    after changed_all() (i.e. after a Vera sync).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.dirty = {}
+        self.all_dirty = False
+
+    def load(self, registry, sync_state, sensors):
+        """Fill an empty registry, sync_state and sensors from the file.
+
+        Arguments:
+        sensors --- dict of Vera deviceid to (address, type), either of
+                    which may be None
+
+        Returns:
+        the number of devices loaded
+        """
+        count = 0
+        for row in self.db.execute('SELECT id, address, kind, last_state, '
+                                   'last_seen, next_poll FROM devices'):
+            device_id, address, kind, last_state, last_seen, next_poll = row
+            device = registry.add(str(device_id), str(address), str(kind))
+            if device is None:
+                continue
+            device.last_state = bool(last_state)
+            device.last_seen = last_seen
+            device.next_poll = next_poll
+            count += 1
+        for device_id, address, kind in self.db.execute(
+                'SELECT id, address, kind FROM sensors'):
+            sensors[str(device_id)] = (
+                None if address is None else str(address),
+                None if kind is None else str(kind))
+        for key, value in self.db.execute('SELECT key, value FROM sync'):
+            sync_state[str(key)] = value
+        return count
+
+    def changed(self, device):
+        """Note that a device needs writing."""
+        self.dirty[device.id] = device
+
+    def changed_all(self):
+        """Note that the whole device list and sync state need writing."""
+        self.all_dirty = True
+
+    def flush(self, registry, sync_state, sensors):
+        """Write out everything that has changed since the last flush."""
+        if self.all_dirty:
+            changed = list(registry)
+        else:
+            changed = [device for device in registry
+                       if device.last_state or device.id in self.dirty]
+        rows = [(device.id, device.address, device.kind,
+                 int(device.last_state), device.last_seen, device.next_poll)
+                for device in changed]
+        try:
+            with self.db:
+                if self.all_dirty:
+                    self.db.execute('DELETE FROM devices')
+                    self.db.execute('DELETE FROM sync')
+                    self.db.execute('DELETE FROM sensors')
+                    self.db.executemany(
+                        'INSERT INTO sensors VALUES (?, ?, ?)',
+                        [(device_id, address, kind) for device_id,
+                         (address, kind) in sensors.iteritems()])
+                    self.db.executemany('INSERT INTO sync VALUES (?, ?)',
+                                        sync_state.items())
+                self.db.executemany('INSERT OR REPLACE INTO devices VALUES '
+                                    '(?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error, e:
+            logger.debug('Failed to save state to %s: %s' % (self.path, e))
+            return
+        self.dirty.clear()
+        self.all_dirty = False
@@ -0,0 +1,410 @@
+"""Talking to the Vera home controller."""
+
+import httplib
+import json
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+import urllib
+import metrics
+
+try:
+    import ijson
+    import ijson.common
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger('Bluetooth Scanner')
+
+request_latency = metrics.histogram('vera_request_seconds',
+                                    'Time taken by requests to Vera')
+status_latency = metrics.histogram('vera_status_seconds',
+                                   'Time taken by status long polls to Vera')
+request_failures = metrics.counter('vera_request_failures_total',
+                                   'Requests to Vera that failed')
+dropped_updates = metrics.counter('vera_updates_dropped_total',
+                                  'Updates dropped with the Vera queue full')
+
+# What Vera sends instead of a document that has not changed
+NO_CHANGES = 'NO_CHANGES'
+
+
+class VeraConnection(object):
+    """A keep-alive HTTP connection to Vera's luup request port.
+
+    Not thread safe; each thread talking to Vera should have its own.
+    """
+
+    def __init__(self, host, port=3480, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def open(self, msg):
+        """Send a request to Vera and return the response to be read.
+
+        Arguments:
+        msg --- the partial url of the message starting after <address:port>/
+
+        Raises IOError (or a subclass) if Vera could not be reached or did not
+        answer with 200 OK.  The connection is dropped and reopened on the
+        next request when that happens.  The response must be read to the end
+        (or the connection closed) before the next request.
+        """
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.host, self.port,
+                                               timeout=self.timeout)
+        try:
+            self.conn.request('GET', '/' + msg)
+            response = self.conn.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            self.close()
+            raise IOError('Vera request failed: %s' % e)
+        if response.status != 200:
+            self.close()
+            raise IOError('Vera replied %d %s' % (response.status,
+                                                   response.reason))
+        return response
+
+    def request(self, msg, latency=request_latency):
+        """Send a request to Vera and return the body of the reply.
+
+        See open() for arguments and errors.  The time taken is recorded in
+        the latency histogram.
+        """
+        start = time.time()
+        try:
+            response = self.open(msg)
+            try:
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                raise IOError('Vera request failed: %s' % e)
+        except IOError:
+            request_failures.inc()
+            raise
+        if response.will_close:
+            self.close()
+        latency.observe(time.time() - start)
+        return data
+
+    def user_data(self, device_type, data_version=None):
+        """Fetch Vera's devices of one type from the user_data document.
+
+        The document is parsed as it is downloaded (with ijson when it is
+        installed) and only devices of the wanted type are kept.
+
+        Arguments:
+        device_type --- the device_type of the devices wanted
+        data_version --- the DataVersion from the last fetch, if any, so
+                         Vera can skip sending an unchanged document
+
+        Returns:
+        (DataVersion, LoadTime, devices), or None if nothing has changed
+        since data_version.
+        """
+        msg = 'data_request?id=user_data&output_format=json'
+        if data_version is not None:
+            msg += '&DataVersion=%s' % data_version
+        start = time.time()
+        try:
+            response = self.open(msg)
+        except IOError:
+            request_failures.inc()
+            raise
+        try:
+            head = response.read(len(NO_CHANGES))
+            if head == NO_CHANGES:
+                response.read()
+                result = None
+            else:
+                result = parse_user_data(_Prefixed(head, response),
+                                         device_type)
+        except (httplib.HTTPException, socket.error, ValueError), e:
+            self.close()
+            request_failures.inc()
+            raise IOError('Vera user_data failed: %s' % e)
+        if response.will_close:
+            self.close()
+        request_latency.observe(time.time() - start)
+        return result
+
+    def status(self, data_version, load_time, timeout, minimum_delay):
+        """Wait for changes to Vera's devices since data_version.
+
+        Vera answers as soon as anything has changed, or after timeout, so
+        the connection's own timeout must be longer than that.
+
+        Arguments:
+        data_version --- the DataVersion from the last status or user_data
+        load_time --- the LoadTime from the last status or user_data
+        timeout --- the longest time Vera should wait for a change (s)
+        minimum_delay --- how long Vera should wait for further changes to
+                          send with the first one (s)
+
+        Returns:
+        the parsed status document, with only the devices and variables
+        that have changed.  If Vera has been reloaded since load_time, its
+        LoadTime is different and all devices are included.
+        """
+        msg = ('data_request?id=status&output_format=json&DataVersion=%s'
+               '&LoadTime=%s&Timeout=%d&MinimumDelay=%d'
+               % (data_version, load_time, timeout, minimum_delay * 1000))
+        # Vera holds the request open until something changes, so its time
+        # says how quiet Vera was rather than how quickly it answered
+        data = self.request(msg, status_latency)
+        try:
+            return json.loads(data)
+        except ValueError, e:
+            request_failures.inc()
+            raise IOError('Vera status failed: %s' % e)
+
+
+class _Prefixed(object):
+    """A file like object replaying some already read bytes before fp."""
+
+    def __init__(self, head, fp):
+        self.head = head
+        self.fp = fp
+
+    def read(self, size=-1):
+        head = self.head
+        if size is None or size < 0:
+            self.head = ''
+            return head + self.fp.read()
+        if not head:
+            return self.fp.read(size)
+        self.head = head[size:]
+        return head[:size]
+
+
+def parse_user_data(fp, device_type):
+    """Parse a user_data document keeping only devices of one type.
+
+    Returns:
+    (DataVersion, LoadTime, devices)
+    """
+    if ijson is None:
+        data = json.load(fp)
+        return (data.get('DataVersion'), data.get('LoadTime'),
+                [dev for dev in data.get('devices', [])
+                 if dev.get('device_type') == device_type])
+    info = {}
+    devices = []
+    builder = None
+    for prefix, event, value in ijson.parse(fp):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'devices.item' and event == 'end_map':
+                if builder.value.get('device_type') == device_type:
+                    devices.append(builder.value)
+                builder = None
+        elif prefix == 'devices.item' and event == 'start_map':
+            builder = ijson.common.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix in ('DataVersion', 'LoadTime'):
+            info[prefix] = value
+    return info.get('DataVersion'), info.get('LoadTime'), devices
+
+
+class VeraReporter(threading.Thread):
+    """Send SetPresent actions to Vera from a background thread.
+
+    set_present() never blocks.  Actions waiting to be sent are kept per
+    device, so a newer value for a device replaces one that has not gone out
+    yet.  While Vera can't be reached, the thread retries with an exponential
+    backoff.
+    """
+
+    def __init__(self, connection, service_id, max_pending=256,
+                 min_backoff=1, max_backoff=60):
+        threading.Thread.__init__(self, name='VeraReporter')
+        self.daemon = True
+        self.connection = connection
+        self.service_id = service_id
+        self.max_pending = max_pending
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.pending = {}
+        self.order = []
+        self.cond = threading.Condition()
+
+    def set_present(self, device_num, value):
+        """Queue a SetPresent action for a device.
+
+        Arguments:
+        device_num --- the Vera device id
+        value --- the newPresentValue to send
+        """
+        with self.cond:
+            if device_num not in self.pending:
+                if len(self.order) >= self.max_pending:
+                    logger.debug('Vera queue full, dropping update for %s'
+                                 % device_num)
+                    dropped_updates.inc()
+                    return
+                self.order.append(device_num)
+            self.pending[device_num] = value
+            self.cond.notify()
+
+    def _next(self):
+        with self.cond:
+            while not self.order:
+                self.cond.wait()
+            device_num = self.order.pop(0)
+            return device_num, self.pending.pop(device_num)
+
+    def _requeue(self, device_num, value):
+        # Put a failed action back at the front, unless a newer one arrived
+        with self.cond:
+            if device_num not in self.pending:
+                self.order.insert(0, device_num)
+                self.pending[device_num] = value
+
+    def run(self):
+        backoff = self.min_backoff
+        while True:
+            device_num, value = self._next()
+            msg = ('data_request?id=action&DeviceNum=%s&serviceId=%s'
+                   '&action=SetPresent&newPresentValue=%s'
+                   % (device_num, self.service_id,
+                      urllib.quote(value, safe=',')))
+            try:
+                self.connection.request(msg)
+            except IOError, e:
+                logger.debug('Failed to update Vera (%s), retrying in %d secs'
+                             % (e, backoff))
+                self._requeue(device_num, value)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.min_backoff
+
+
+class VeraSubscriber(threading.Thread):
+    """Follow changes to Vera's devices of one type from a background thread.
+
+    The device list is fetched from user_data first, and again when Vera's
+    LoadTime changes (devices are only added or deleted with a Luup reload)
+    or every sync_period, when Vera only sends it again if anything has
+    changed since the last DataVersion.  In between, Vera's status is long
+    polled and the devices where any of the given variables changed are
+    passed on.  Each update is (full, DataVersion, LoadTime, devices), where
+    full says the devices are the whole list rather than just those that
+    changed.  fileno() becomes readable when there are updates, so the
+    subscriber can be used with select().  stop() ends the thread once the
+    request in progress, at most poll_timeout, returns.
+    """
+
+    def __init__(self, connection, device_type, service_id, variables,
+                 poll_timeout=60, minimum_delay=1, sync_period=3600,
+                 min_backoff=1, max_backoff=60):
+        """
+        Arguments:
+        connection --- a VeraConnection whose timeout is longer than
+                       poll_timeout
+        device_type --- the device_type of the devices wanted
+        service_id --- the service of the variables to watch
+        variables --- the names of the variables to watch
+        """
+        threading.Thread.__init__(self, name='VeraSubscriber')
+        self.daemon = True
+        self.connection = connection
+        self.device_type = device_type
+        self.service_id = service_id
+        self.variables = variables
+        self.poll_timeout = poll_timeout
+        self.minimum_delay = minimum_delay
+        self.sync_period = sync_period
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.data_version = None
+        self.load_time = None
+        self.next_sync = 0
+        self.updates = Queue.Queue()
+        self.wake_r, self.wake_w = os.pipe()
+        self.stopped = threading.Event()
+
+    def resume(self, data_version, load_time):
+        """Start from an earlier sync's DataVersion and LoadTime.
+
+        Must be called before start().  The first full sync is put off
+        for sync_period, so only the changes since then are fetched.
+        """
+        self.data_version = data_version
+        self.load_time = load_time
+        if load_time is not None:
+            self.next_sync = time.time() + self.sync_period
+
+    def stop(self):
+        """Ask the thread to finish; join() waits for it."""
+        self.stopped.set()
+
+    def fileno(self):
+        return self.wake_r
+
+    def get_updates(self):
+        """Return the updates ready so far."""
+        os.read(self.wake_r, 4096)
+        updates = []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except Queue.Empty:
+                return updates
+
+    def _put(self, full, devices):
+        self.updates.put((full, self.data_version, self.load_time, devices))
+        os.write(self.wake_w, 'x')
+
+    def _sync(self):
+        # Only once this succeeds is there a DataVersion to poll status from
+        result = self.connection.user_data(self.device_type, self.data_version)
+        self.next_sync = time.time() + self.sync_period
+        if result is None:
+            return
+        self.data_version, self.load_time, devices = result
+        self._put(True, devices)
+
+    def _poll(self):
+        status = self.connection.status(self.data_version, self.load_time,
+                                        self.poll_timeout,
+                                        self.minimum_delay)
+        if status.get('LoadTime') != self.load_time:
+            logger.debug('Vera has been reloaded, fetching device list')
+            self.data_version = None
+            self.next_sync = 0
+            return
+        self.data_version = status.get('DataVersion', self.data_version)
+        changed = [device for device in status.get('devices', [])
+                   if any(state.get('service') == self.service_id
+                          and state.get('variable') in self.variables
+                          for state in device.get('states', []))]
+        if changed:
+            self._put(False, changed)
+
+    def run(self):
+        backoff = self.min_backoff
+        while not self.stopped.is_set():
+            try:
+                if time.time() >= self.next_sync:
+                    self._sync()
+                else:
+                    self._poll()
+            except IOError, e:
+                logger.debug('Failed to get changes from Vera (%s), '
+                             'retrying in %d secs' % (e, backoff))
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.min_backoff
+        self.connection.close()